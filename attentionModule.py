@@ -4,6 +4,7 @@ import torch.nn.functional as F
 import dgl
 import numpy as np 
 import dgl.function as fn
+from dgl.nn.functional import edge_softmax
 
 class GATInnerLayer(nn.Module):
     def __init__(self, in_dim, out_dim):
@@ -22,38 +23,6 @@ class GATInnerLayer(nn.Module):
         nn.init.xavier_normal_(self.kMask.weight, gain=gain)
         nn.init.xavier_normal_(self.vMask.weight, gain=gain)
 
-    def edge_attention(self, edges):
-        # edge UDF for equation (2)
-        qVal = self.qMask(edges.src['h'])
-        kVal = self.kMask(edges.src['h'])
-        qVal = torch.unsqueeze(qVal, 2)
-        kVal = torch.unsqueeze(kVal, 1)
-        score = (kVal.T @ qVal.T )  / np.sqrt(self.in_dim)
-        score = F.softmax(score, dim=-1)
-        origin = torch.unsqueeze(edges.src['h'], 2)
-        attVal = torch.bmm(score, origin).sum(dim = 2)
-        # print(attVal.shape)
-        return {'a': attVal}
-
-    def message_func(self, edges):
-        # message UDF for equation (3) & (4)
-        return {'a': edges.data['a']}
-
-    def reduce_func(self, nodes):
-        # self.counter += 1
-        # print(f"debug counter at: {self.counter}")
-        # print(nodes.mailbox)
-        # datas =nodes.mailbox['a'] 
-
-        # print(datas.shape)
-        # print(score.shape)
-        # lenFeature = datas.shape[-1]
-        # datas = datas.reshape(-1, lenFeature)
-        # print(datas.shape)
-        out = torch.mean(nodes.mailbox['a'] , dim = 1)
-        # print(out.shape)
-        return {'h': out}
-
     def forward(self, g, h):
         qVal = self.qMask(h)
         kVal = self.kMask(h)
@@ -65,11 +34,6 @@ class GATInnerLayer(nn.Module):
         origin = torch.unsqueeze(vVal, 2)
         attVal = torch.bmm(score, origin).sum(dim = 2)
         return attVal
-        # g.ndata['h'] = h
-        # g.apply_edges(self.edge_attention)
-
-        # g.update_all(self.message_func, self.reduce_func)
-        # return g.ndata.pop('h')
 
 class GATInnerLayer_v2(nn.Module):
     def __init__(self, in_dim, out_dim):
@@ -232,6 +196,58 @@ class MultiHeadGATCrossModal(nn.Module):
             # merge using average
             return torch.mean(torch.stack(head_outs))
 
+class MultiHeadGraphCrossModal(nn.Module):
+    """
+    Cross-modal attention along the graph edges: the query of one modality at utterance i attends over
+    the keys/values of another modality at every utterance j with an edge j -> i.
+    All heads and modality pairs run at once on DGL built-in kernels (u_dot_v, edge_softmax, u_mul_e + sum),
+    so the cost scales with the number of edges.
+    """
+    # (query modality, key modality) over (text, audio, vision), the pairs of crossModal
+    pairs = ((0, 1), (1, 0), (2, 0), (0, 2), (1, 2), (2, 1))
+
+    def __init__(self, in_dim, out_dim, num_heads):
+        super(MultiHeadGraphCrossModal, self).__init__()
+        tt, aa, vv  = 64, 128, 192
+        if in_dim == 1247:
+            tt, aa, vv  = 600, 942, 1247
+        self.split = (tt, aa-tt, vv-aa)
+        self.in_dim = in_dim
+        self.out_dim = out_dim
+        self.num_heads = num_heads
+        self.qMask = nn.ModuleList([nn.Linear(dim, num_heads * out_dim, bias=False) for dim in self.split])
+        self.kMask = nn.ModuleList([nn.Linear(dim, num_heads * out_dim, bias=False) for dim in self.split])
+        self.vMask = nn.ModuleList([nn.Linear(dim, num_heads * out_dim, bias=False) for dim in self.split])
+        self.ln = nn.Linear(len(self.pairs) * num_heads * out_dim, num_heads * out_dim, bias = True)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        """Reinitialize learnable parameters."""
+        gain = nn.init.calculate_gain('relu')
+        for layer in [*self.qMask, *self.kMask, *self.vMask, self.ln]:
+            nn.init.xavier_normal_(layer.weight, gain=gain)
+        nn.init.constant_(self.ln.bias, 0)
+
+    def forward(self, g, h):
+        numNode = len(h)
+        feature = torch.split(h, self.split, dim = 1)
+        qVal = [layer(ft) for layer, ft in zip(self.qMask, feature)]
+        kVal = [layer(ft) for layer, ft in zip(self.kMask, feature)]
+        vVal = [layer(ft) for layer, ft in zip(self.vMask, feature)]
+        # one attention "head" per (pair, head): numNode x (pairs * heads) x out_dim
+        shape = (numNode, len(self.pairs) * self.num_heads, self.out_dim)
+        qVal = torch.stack([qVal[qq] for qq, _ in self.pairs], 1).view(shape)
+        kVal = torch.stack([kVal[kk] for _, kk in self.pairs], 1).view(shape)
+        vVal = torch.stack([vVal[kk] for _, kk in self.pairs], 1).view(shape)
+        with g.local_scope():
+            g.srcdata.update({'k': kVal, 'v': vVal})
+            g.dstdata['q'] = qVal
+            g.apply_edges(fn.u_dot_v('k', 'q', 'score'))
+            g.edata['a'] = edge_softmax(g, g.edata['score'] / np.sqrt(self.out_dim))
+            g.update_all(fn.u_mul_e('v', 'a', 'm'), fn.sum('m', 'att'))
+            att = g.dstdata['att'].reshape(numNode, -1)
+        return self.ln(att)
+
 # g = dgl.graph(([0,1,2,3,2,5], [1,2,3,4,0,3]))
 # g = dgl.add_self_loop(g)
 # feat = torch.rand(6, 10)
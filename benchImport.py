@@ -0,0 +1,60 @@
+"""
+Cold start benchmark of the entry points.
+Every module is imported in a fresh interpreter right after a bare `import torch, dgl`, which is the floor
+(dgl itself already pulls in dgl.data, networkx, pandas, scipy and tqdm). Only the import on top of the floor is
+timed, in the same interpreter, so the result does not move with the load time of torch and dgl on the host.
+Fails when a heavy module we load lazily leaks into an import graph, or when the import overhead above the floor
+exceeds --budget seconds.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+ENTRY = ('main', 'config', 'model', 'dataloader', 'quantize', 'embedding', 'compressFeatures', 'serve')
+HEAVY = ('matplotlib', 'seaborn', 'sklearn')
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import torch, dgl
+floor = time.perf_counter()
+{imports}
+end = time.perf_counter()
+print(json.dumps({{'floor': floor - start, 'overhead': end - floor, 'heavy': [name for name in {heavy} if name in sys.modules]}}))
+'''
+
+
+def coldImport(imports, repeat):
+    code = PROBE.format(imports=imports, heavy=HEAVY)
+    floor, overhead, heavy = [], [], []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                             capture_output=True, text=True, check=True)
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        floor.append(result['floor'])
+        overhead.append(result['overhead'])
+        heavy = result['heavy']
+    return float(np.median(floor)), float(np.median(overhead)), heavy
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', help='fresh interpreters per module, the median is kept', default=5, type=int)
+    parser.add_argument('--budget', help='allowed import time above torch + dgl, in seconds', default=0.3, type=float)
+    parser.add_argument('--modules', nargs='+', help='entry points to check', default=list(ENTRY))
+    args = parser.parse_args()
+
+    failed = False
+    for name in args.modules:
+        floor, overhead, heavy = coldImport(f'import {name}', args.repeat)
+        status = 'ok'
+        if heavy:
+            status = f'FAIL heavy modules {heavy}'
+        elif overhead > args.budget:
+            status = f'FAIL overhead above {args.budget:.3f}s'
+        failed = failed or status != 'ok'
+        print(f'{name:<16} torch + dgl {floor:.3f}s overhead {overhead:+.3f}s {status}')
+    sys.exit(1 if failed else 0)
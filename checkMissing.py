@@ -0,0 +1,60 @@
+"""
+Check of the missing masks drawn by MissingCollator with --resampleMissing.
+Synthetic dialogues are batched --batches times for every --missing rate, the share of missing modalities
+over the real utterances is compared with the rate. Fails when it is off by more than --tolerance percent.
+"""
+import argparse
+import sys
+
+import numpy as np
+import torch
+
+from dataloader import MissingCollator, dialogueGraph, forwardEdges
+
+DIMS = (1024, 512, 1024)
+
+
+def dialogues(args, rng):
+    items = []
+    for _ in range(args.pool):
+        numNode = int(rng.integers(args.minLen, args.maxLen + 1))
+        features = [np.zeros((numNode, dim), dtype=np.float32) for dim in DIMS]
+        speakers = rng.choice(['M', 'F'], numNode).tolist()
+        items.append(dialogueGraph(*features, np.zeros(numNode), speakers, np.zeros((3, numNode)),
+                                   forwardEdges(numNode, 120), 4))
+    return items
+
+
+def resampledRate(items, missing, args, rng):
+    generator = torch.Generator().manual_seed(args.seed)
+    collate = MissingCollator(missing, resample = True, generator = generator).collate
+    numMissing, numModality = 0, 0
+    for _ in range(args.batches):
+        g, _ = collate([items[ii] for ii in rng.integers(0, len(items), args.batchSize)])
+        oPresent = g.ndata["oPresent"].float()
+        numMissing += float((oPresent * (1 - g.ndata["present"].float())).sum())
+        numModality += float(oPresent.sum())
+    return numMissing / numModality * 100
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--missing', nargs='+', help='missing rates to check, in percent', default=[10, 20, 30, 40, 50, 60], type=int)
+    parser.add_argument('--batches', help='batches drawn per rate', default=200, type=int)
+    parser.add_argument('--batchSize', help='dialogues per batch', default=16, type=int)
+    parser.add_argument('--minLen', help='fewest utterances per dialogue', default=5, type=int)
+    parser.add_argument('--maxLen', help='most utterances per dialogue', default=110, type=int)
+    parser.add_argument('--pool', help='distinct synthetic dialogues', default=64, type=int)
+    parser.add_argument('--tolerance', help='allowed gap between the drawn and the requested rate, in percent', default=1.0, type=float)
+    parser.add_argument('--seed', help='seed of the dialogues and the masks', default=1001, type=int)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    items = dialogues(args, rng)
+    failed = False
+    for missing in args.missing:
+        rate = resampledRate(items, missing, args, rng)
+        status = 'ok' if abs(rate - missing) <= args.tolerance else f'FAIL off by more than {args.tolerance:.1f}%'
+        failed = failed or status != 'ok'
+        print(f'--missing {missing:<3} resampled {rate:6.2f}% {status}')
+    sys.exit(1 if failed else 0)
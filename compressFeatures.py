@@ -0,0 +1,53 @@
+"""
+Writes the utterance features as compact float16 or int8 stores next to the raw .npy directories
+(./IEMOCAP/features/{root}_{format}.npy + _meta.npz), read back with main.py --featureFormat.
+With --modelPath the test F1 of a trained model is reported on the raw features and on every compressed format.
+"""
+import numpy as np
+import torch
+from dgl.dataloading import GraphDataLoader
+
+from config import buildParser, loadDataset
+from dataloader import FEATURE_ROOT, MissingCollator, compressFeatures, read_data, saveCompressed
+from model import GAT_FP
+from ultis import DEVICE, evaluate, seed_everything, seedList
+
+
+def formatF1(args, featureFormat, setSeed):
+    # same seed for every format so the missing masks are identical
+    seed_everything(seed=setSeed)
+    args.featureFormat = featureFormat
+    data, numLB = loadDataset(args, {'missing': args.missing, 'seed': setSeed})
+    testLoader = GraphDataLoader(dataset=data.testSet, batch_size=args.batchSize,
+                                 collate_fn=MissingCollator(quantization = data.testSet.quantization).collate)
+    model = GAT_FP(data.out_size, args.wFP, args, probality = True)
+    model.load_state_dict(torch.load(args.modelPath, map_location=DEVICE))
+    model = model.to(DEVICE)
+    return evaluate(testLoader, model, numLB)
+
+
+if __name__ == "__main__":
+    parser = buildParser()
+    parser.add_argument('--formats', nargs='+', help='float16, int8', default=['float16', 'int8'], choices=['float16', 'int8'])
+    parser.add_argument('--modelPath', help='state dict saved by main.py --saveModel, evaluated on every format', default='')
+    args = parser.parse_args()
+
+    numLB = 4 if args.numLabel == '4' else 6
+    labelPath = f'./IEMOCAP/IEMOCAP_features_raw_{numLB}way.pkl'
+    for modality, featureRoot in FEATURE_ROOT.items():
+        name2feats, _ = read_data(labelPath, featureRoot)
+        original = np.vstack([name2feats[name] for name in name2feats]).astype(np.float32)
+        for featureFormat in args.formats:
+            names, codes, scale, offset = compressFeatures(name2feats, featureFormat)
+            saveCompressed(featureRoot, featureFormat, names, codes, scale, offset)
+            error = np.abs(codes.astype(np.float32) * scale + offset - original).mean()
+            print(f'{modality:<7} {featureFormat:<8} {original.nbytes / 2**20:8.1f}MB -> {codes.nbytes / 2**20:8.1f}MB '
+                  f'mean abs error {error:.2e}')
+
+    if args.modelPath:
+        setSeed = seedList[0] if args.seed == 'random' else int(args.seed)
+        acc = formatF1(args, 'float32', setSeed)
+        print(f'F1 float32 {acc:.4f}')
+        for featureFormat in args.formats:
+            qAcc = formatF1(args, featureFormat, setSeed)
+            print(f'F1 {featureFormat:<7} {qAcc:.4f} | delta {qAcc - acc:+.4f}')
@@ -0,0 +1,74 @@
+"""Command line flags and dataset loading shared by the training, inference and tool entry points."""
+import argparse
+
+from dataloader import Iemocap6_Gcnet_Dataset
+
+
+class GraphCrossModalAction(argparse.Action):
+    # the graph cross-modal attention replaces gat2, which only runs with --crossModal
+    def __init__(self, option_strings, dest, **kwargs):
+        super().__init__(option_strings, dest, nargs=0, default=False, **kwargs)
+
+    def __call__(self, parser, namespace, values, option_string = None):
+        setattr(namespace, self.dest, True)
+        namespace.crossModal = True
+
+
+def buildParser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--E', help='number of epochs', default=50, type=int)
+    parser.add_argument('--seed', help='type of seed: random vs fix', default='random')
+    parser.add_argument('--lr', help='learning rate', default=0.003, type=float)
+    parser.add_argument('--rho', help='probality default', default=-1.0, type=float)
+    parser.add_argument('--weight_decay', help='weight decay', default=0.00001, type=float)
+    parser.add_argument('--edgeType', help='type of edge:0 for similarity and 1 for forward complete', default=1, type=int)
+    parser.add_argument('--simTopK', help='similarity edges: keep the k most similar utterances, 0 for all', default=10, type=int)
+    parser.add_argument('--simThreshold', help='similarity edges: drop edges below this angular similarity', default=0.0, type=float)
+    parser.add_argument('--missing', help='percentage of missing utterance in MM data', default=0, type=int)
+    parser.add_argument('--resampleMissing', action='store_true', default=False, help='draw new missing masks for every training batch')
+    parser.add_argument('--wFP', action='store_true', default=False, help='edge direction type')
+    parser.add_argument('--numTest', help='number of test', default=10, type=int)
+    parser.add_argument('--ensemble', action='store_true', default=False, help='train the numTest seeds together as one ensemble in a single process')
+    parser.add_argument('--evalEvery', help='evaluate on the test set every k epochs (and after the last one)', default=1, type=int)
+    parser.add_argument('--asyncEval', action='store_true', default=False, help='evaluate a copy of the weights on a background thread while the next epoch trains')
+    parser.add_argument('--batchSize', help='size of batch', default=64, type=int)
+    parser.add_argument('--batchBudget', help='pack length-bucketed batches up to this cost instead of --batchSize, 0 to disable', default=0, type=int)
+    parser.add_argument('--budgetUnit', help='cost of a dialogue in the batch budget: utterance (120 padded rows + utterances) or edge',
+                        default='utterance', choices=['utterance', 'edge'])
+    parser.add_argument('--log', action='store_true', default=True, help='save experiment info in output')
+    parser.add_argument('--output', help='savedFile', default='./log_v2.txt')
+    parser.add_argument('--featureFormat', help='float32 (raw .npy), float16 or int8 (written by compressFeatures.py)', default='float32',
+                        choices=['float32', 'float16', 'int8'])
+    parser.add_argument('--prePath', help='prepath to directory contain DGL files', default='.')
+    parser.add_argument('--numLabel', help='4label vs 6label', default='6')
+    parser.add_argument('--featureEstimate', help='Zero, Mean (speaker/dialogue mean of present features), FE (learned)', default='FE',
+                        choices=['FE', 'Mean', 'Zero'])
+    parser.add_argument('--crossModal',action='store_true', default=False, help='using crossModal')
+    parser.add_argument('--graphCrossModal', action=GraphCrossModalAction, help='crossModal attends over neighbouring utterances along graph edges, implies --crossModal')
+    parser.add_argument('--usingGAT',action='store_true', default=False, help='using GAT')
+    parser.add_argument('--loss', help='classification loss: ce or focal', default='ce', choices=['ce', 'focal'])
+    parser.add_argument('--gamma', help='focusing parameter of the focal loss', default=2.5, type=float)
+    parser.add_argument('--classWeight', action='store_true', default=False, help='weight classes by inverse train frequency')
+    parser.add_argument('--lossReduction', help='mean or sum over the utterances of a batch', default='mean', choices=['mean', 'sum'])
+    parser.add_argument('--reconstructionLoss', 
+        help='mse, kl, none. unless set rho number for kl loss, using none loss instead',
+        default='none')
+    parser.add_argument( "--dataset",
+        type=str,
+        default="IEMOCAP",
+        help="Dataset name ('IEMOCAP', 'MELD').",
+    )
+    parser.add_argument('--saveModel', help='path to save the trained state dict, empty to skip', default='')
+    return parser
+
+
+def loadDataset(args, info):
+    numLB = 6
+    if args.numLabel =='4':
+        numLB = 4
+    dataPath  = f'./IEMOCAP/IEMOCAP_features_raw_{numLB}way.pkl'
+    data = Iemocap6_Gcnet_Dataset(missing = args.missing, path = dataPath, info = info,
+                                  edgeType = args.edgeType, topK = args.simTopK, threshold = args.simThreshold,
+                                  featureFormat = args.featureFormat)
+    return data, numLB
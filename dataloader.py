@@ -2,17 +2,12 @@ import numpy as np
 import dgl
 import torch
 import os
-from dgl.data import DGLDataset
+from dgl.dataloading import GraphCollator
 from torch.utils.data import Dataset
 import random
-from ultis import *
+from ultis import angularSimilarity
 import pickle
 
-import glob
-import tqdm
-import pandas as pd
-from torch.nn.utils.rnn import pad_sequence
-
 def missingParam(percent):
     al, be , ga = 0, 0, 0
     for aa in range(1, 200):
@@ -24,6 +19,24 @@ def missingParam(percent):
     return al, be, ga
 
 
+def missingProbs(percent):
+    """
+    Probabilities of MissingCollator.patterns (complete, one and two modalities missing) with an expected
+    missing rate (p1 + 2 * p2) / 3 of percent / 100. The one and two missing groups keep the ratio of
+    missingParam and are scaled together, above the rate they reach this way the complete pattern is dropped.
+    """
+    rate = percent / 100
+    if rate > 2 / 3:
+        raise ValueError(f'at most two of the three modalities of an utterance are missing, got --missing {percent}')
+    al, be, ga = missingParam(percent)
+    p1, p2 = 2 - 3 * rate, 3 * rate - 1
+    if be + ga > 0:
+        scale = 3 * rate / (be + 2 * ga)
+        if (be + ga) * scale <= 1:
+            p1, p2 = be * scale, ga * scale
+    return torch.tensor([1 - p1 - p2] + [p1 / 3] * 3 + [p2 / 3] * 3, dtype=torch.float)
+
+
 def genMissMultiModal(matSize, percent):
     index = (percent-10) // 10
     types = np.asarray([[0, 0, 1], [0, 1, 0], [1, 0, 0]])
@@ -104,14 +117,171 @@ def read_data(label_path, feature_root):
     return name2feats, feature_dim
 
 
-class IEMOCAP6DGL_GCNET(DGLDataset):
-    def __init__(self, trainVids, videoIDs, videoLabels, name2audio, name2text, name2video, missing):
+FEATURE_ROOT = {
+    'text': './IEMOCAP/features/deberta-large-4-UTT',
+    'audio': './IEMOCAP/features/wav2vec-large-c-UTT',
+    'vision': './IEMOCAP/features/manet_UTT',
+}
+
+
+def compressFeatures(name2feats, featureFormat):
+    """
+    Per dimension scale/offset quantization of a name -> feature dict.
+    float16: standardised features (offset mean, scale std), int8: 8 bit codes over [min, max] of each dimension.
+    Returns names, codes, scale and offset with feature = codes * scale + offset.
+    """
+    names = list(name2feats)
+    features = np.vstack([name2feats[name] for name in names]).astype(np.float32)
+    if featureFormat == 'int8':
+        offset = features.min(0)
+        scale = (features.max(0) - offset) / 255
+        scale[np.where(scale == 0)] = 1
+        codes = np.clip(np.round((features - offset) / scale), 0, 255).astype(np.uint8)
+    elif featureFormat == 'float16':
+        offset = features.mean(0)
+        scale = features.std(0)
+        scale[np.where(scale == 0)] = 1
+        codes = ((features - offset) / scale).astype(np.float16)
+    else:
+        raise ValueError(f"unknown feature format {featureFormat}, expected float16 or int8")
+    return names, codes, scale.astype(np.float32), offset.astype(np.float32)
+
+
+def saveCompressed(feature_root, featureFormat, names, codes, scale, offset):
+    # codes in a plain .npy so they can be memory mapped, names and scale/offset beside them
+    np.save(f'{feature_root}_{featureFormat}.npy', codes)
+    np.savez(f'{feature_root}_{featureFormat}_meta.npz', names=np.asarray(names), scale=scale, offset=offset)
+
+
+def read_compressed(feature_root, featureFormat):
+    codes = np.load(f'{feature_root}_{featureFormat}.npy', mmap_mode='r')
+    meta = np.load(f'{feature_root}_{featureFormat}_meta.npz')
+    name2feats = {name: codes[ii] for ii, name in enumerate(meta['names'])}
+    print (f'Input feature {os.path.basename(feature_root)} ({featureFormat}) ===> dim is {codes.shape[1]}; No. sample is {len(name2feats)}')
+    return name2feats, codes.shape[1], (torch.from_numpy(meta['scale']), torch.from_numpy(meta['offset']))
+
+
+def dequantize(codes, quantization):
+    scale, offset = quantization
+    return codes.float() * scale.to(codes.device) + offset.to(codes.device)
+
+
+def speakerIndex(speakers):
+    # speakers are 'M'/'F' tags or one-hot vectors depending on the pkl, map them to 0..k-1 per dialogue
+    tags = [spk if isinstance(spk, str) else int(np.argmax(spk)) for spk in speakers]
+    order = {tag: idx for idx, tag in enumerate(dict.fromkeys(tags))}
+    return np.asarray([order[tag] for tag in tags])
+
+
+def forwardEdges(numNode, outSize):
+    # utterance i -> every later utterance of the dialogue, self loops on the padding nodes
+    src = []
+    dst = []
+    for node in range(numNode):
+        for nodeAdj in range(node, numNode+1):
+            src.append(node)
+            dst.append(nodeAdj)
+
+    for ii in range(numNode, outSize):
+        src.append(ii)
+        dst.append(ii)
+    return src, dst, None
+
+
+def similarityGraph(features, missingMask, topK, threshold, maxSize = 120, quantization = None):
+    """
+    Edges j -> i for the topK most similar utterances j of i (and/or similarity >= threshold),
+    weighted by the angular similarity over the modalities both have, plus self loops on padding nodes.
+    """
+    numNode = len(features[0])
+    dim = max(ft.shape[1] for ft in features)
+    stack = torch.zeros(len(features), numNode, dim)
+    for ii, ft in enumerate(features):
+        ft = torch.from_numpy(ft)
+        if quantization is not None:
+            ft = dequantize(ft, quantization[('text', 'audio', 'vision')[ii]])
+        stack[ii, :, :ft.shape[1]] = ft
+    present = torch.from_numpy(1 - missingMask).float()
+    similar = angularSimilarity(stack, present)
+    similar.fill_diagonal_(1.0)
+
+    if topK > 0:
+        value, src = torch.topk(similar, min(topK, numNode), dim=1)
+        dst = torch.arange(numNode).unsqueeze(1).expand_as(src)
+    else:
+        value, src = similar, torch.arange(numNode).expand(numNode, numNode)
+        dst = src.T
+    keep = value >= threshold
+    pad = torch.arange(numNode, maxSize)
+    src = torch.cat((src[keep], pad))
+    dst = torch.cat((dst[keep], pad))
+    weight = torch.cat((value[keep], torch.ones(len(pad))))
+    return src, dst, weight
+
+
+def dialogueGraph(text, audio, vision, labels, speakers, missingMask, edges, padLabel, maxSize = 120):
+    """
+    DGL graph of one dialogue padded to maxSize nodes, shared by the dataset and serve.py.
+    text/audio/vision are (numNode, dim) arrays (float32 or compressed codes), missingMask is (3, numNode)
+    with 1 for a missing modality, edges is (src, dst, weight or None), padding nodes get padLabel.
+    """
+    numNode = len(text)
+
+    def compensation(features, size):
+        shape = features.shape
+        features = torch.from_numpy(features)
+        compensationF = torch.zeros(size-shape[0], shape[1], dtype=features.dtype)
+        features = torch.vstack((features, compensationF))
+        return features
+
+    text = compensation(text, maxSize)
+    audio = compensation(audio, maxSize)
+    vision = compensation(vision, maxSize)
+
+    compensation = torch.ones(maxSize-numNode)*padLabel
+    labels = torch.from_numpy(np.asarray(labels))
+    labels = torch.hstack((labels, compensation))
+
+    # per node missing mask and modality presence before masking (text, audio, vision), padding nodes have none
+    missing = torch.zeros(maxSize, 3, dtype=torch.uint8)
+    missing[:numNode] = torch.from_numpy(missingMask.T).to(torch.uint8)
+    oPresent = torch.zeros(maxSize, 3, dtype=torch.uint8)
+    oPresent[:numNode] = 1
+    speaker = torch.zeros(maxSize, dtype=torch.int64)
+    speaker[:numNode] = torch.from_numpy(speakerIndex(speakers))
+
+    src, dst, weight = edges
+    g = dgl.graph((src, dst), num_nodes=maxSize)
+    if weight is not None:
+        g.edata["w"] = weight
+    # float32 or compressed codes, the model casts the rows it reads
+    g.ndata["text"] = text
+    g.ndata["audio"] = audio
+    g.ndata["vision"] = vision
+    g.ndata["label"] = labels.to(torch.float64)
+    g.ndata["speaker"] = speaker
+    g.ndata["missing"] = missing
+    g.ndata["oPresent"] = oPresent
+    return g, labels
+
+
+class IEMOCAP6DGL_GCNET(Dataset):
+    def __init__(self, trainVids, videoIDs, videoLabels, videoSpeakers, name2audio, name2text, name2video, missing,
+                 edgeType = 1, topK = 10, threshold = 0.0, quantization = None):
         
         self.trainVids = trainVids
         self.videoIDs = videoIDs
         self.videoLabels = videoLabels
+        self.videoSpeakers = videoSpeakers
         self.missing = missing
         self.name2audio, self.name2text, self.name2video, = name2audio, name2text, name2video
+        # edgeType 0: top-k / thresholded similarity edges, 1: forward complete edges
+        self.edgeType = edgeType
+        self.topK = topK
+        self.threshold = threshold
+        self.edgeCache = {}
+        # modality -> (scale, offset) when the features are compressed codes, dequantized by MissingCollator
+        self.quantization = quantization
         self.listMask = []
         self.maxSize = 120
         randSTR = random.randint(0, 1000)
@@ -142,89 +312,152 @@ class IEMOCAP6DGL_GCNET(DGLDataset):
         #     counter += np.sum(xx)/np.sum(np.ones_like(xx))
         # print(counter / len(self.listMask))
         # stop
-        super().__init__(name='dataset_DGL')
+        super().__init__()
 
 
     def __getitem__(self, index):
         name = self.trainVids[index]
-        textf = []
-        audiof = []
-        visionf = []
-        for i, vid in enumerate(self.videoIDs[name]):
-            textf.append(np.copy(self.name2text[vid]))
-            audiof.append(np.copy(self.name2audio[vid]))
-            visionf.append(np.copy(self.name2video[vid]))
-        text = np.vstack(textf)
-        audio = np.vstack(audiof)
-        vision = np.vstack(visionf)
-
-        oText = np.copy(text)
-        oAudio = np.copy(audio)
-        oVision = np.copy(vision)
-
-        numNode = len(text)
+        # original features are stacked once, the missing mask is applied on the batch by MissingCollator
+        text = np.vstack([self.name2text[vid] for vid in self.videoIDs[name]])
+        audio = np.vstack([self.name2audio[vid] for vid in self.videoIDs[name]])
+        vision = np.vstack([self.name2video[vid] for vid in self.videoIDs[name]])
+        if self.quantization is None:
+            text, audio, vision = [ft.astype(np.float32, copy=False) for ft in (text, audio, vision)]
+
         missingMask = self.listMask[index]
-        for ii in range(numNode):
-            if missingMask[0][ii] == 1:
-                text[ii] = 0
-            if missingMask[1][ii] == 1:
-                audio[ii] = 0
-            if missingMask[2][ii] == 1:
-                vision[ii] = 0
-
-        labels = np.asarray(self.videoLabels[name])
-        src = []
-        dst = []
-
-        for node in range(numNode):
-            for nodeAdj in range(node, numNode+1):
-                src.append(node)
-                dst.append(nodeAdj)
-        outSize = self.maxSize
-
-        for ii in range(numNode, outSize):
-            src.append(ii)
-            dst.append(ii)
-
-        def compensation(features, size):
-            shape = features.shape
-            compensationF = torch.zeros(size-shape[0], shape[1])
-            features = torch.from_numpy(features)
-            features = torch.vstack((features, compensationF))
-            return features
-
-        text = compensation(text, outSize)
-        audio = compensation(audio, outSize)
-        vision = compensation(vision, outSize)
-
-        oText = compensation(oText, outSize)
-        oAudio = compensation(oAudio, outSize)
-        oVision = compensation(oVision, outSize)
-        
-        compensation = torch.ones(self.maxSize-numNode)*self.out_size
-        labels = torch.from_numpy(labels)
-        labels = torch.hstack((labels, compensation))
-
-        g = dgl.graph((src, dst))
-        g.ndata["text"] = text.to(torch.float64)
-        g.ndata["audio"] = audio.to(torch.float64)
-        g.ndata["vision"] = vision.to(torch.float64)
-        g.ndata["label"] = labels.to(torch.float64)
-
-        g.ndata["oText"] = oText.to(torch.float64)
-        g.ndata["oAudio"] = oAudio.to(torch.float64)
-        g.ndata["oVision"] = oVision.to(torch.float64)
-        return g, labels
+        if self.edgeType == 0:
+            edges = self.similarityEdges(index, [text, audio, vision], missingMask)
+        else:
+            edges = forwardEdges(len(text), self.maxSize)
+        return dialogueGraph(text, audio, vision, self.videoLabels[name], self.videoSpeakers[name], missingMask,
+                             edges, self.out_size, self.maxSize)
 
     def __len__(self):
         return len(self.trainVids) 
 
+    def similarityEdges(self, index, features, missingMask):
+        # cached per dialogue and missing mask
+        key = (index, missingMask.tobytes())
+        if key not in self.edgeCache:
+            self.edgeCache[key] = similarityGraph(features, missingMask, self.topK, self.threshold, self.maxSize, self.quantization)
+        return self.edgeCache[key]
+
+    def listLabel(self):
+        return np.concatenate([np.asarray(self.videoLabels[name]) for name in self.trainVids])
+
+    def dialogueCost(self, index, unit = 'utterance'):
+        numNode = self.listNumNode[index]
+        if unit == 'utterance':
+            # every dialogue is padded to maxSize rows for the LSTM, GAT and cross-modal layers,
+            # the encoders, estimation and loss only see its utterances
+            return self.maxSize + numNode
+        if unit != 'edge':
+            raise ValueError(f"unknown budget unit {unit}, expected utterance or edge")
+        if self.edgeType == 0:
+            # upper bound of the similarity edges plus the self loops of the padding nodes
+            perNode = min(self.topK, numNode) if self.topK > 0 else numNode
+            return numNode * perNode + (self.maxSize - numNode)
+        # forward complete edges plus the self loops of the padding nodes
+        return numNode * (numNode + 3) // 2 + (self.maxSize - numNode)
+
+
+class LengthBucketBatchSampler(torch.utils.data.Sampler):
+    """
+    Packs dialogues of similar length into batches of at most `budget` cost (padded rows + utterances, or edges).
+    Dialogues are shuffled, cut into pools of `poolSize`, sorted by cost inside each pool and packed,
+    then the batches are shuffled again. All randomness comes from `generator`.
+    """
+    def __init__(self, costs, budget, poolSize = 256, shuffle = True, generator = None):
+        self.costs = np.asarray(costs)
+        self.budget = budget
+        self.poolSize = poolSize
+        self.shuffle = shuffle
+        self.generator = generator
+        self.batches = None
+
+    @classmethod
+    def fromDataset(cls, dataset, budget, unit = 'utterance', **kwargs):
+        costs = [dataset.dialogueCost(idx, unit) for idx in range(len(dataset))]
+        return cls(costs, budget, **kwargs)
+
+    def plan(self):
+        numDialogue = len(self.costs)
+        if self.shuffle:
+            order = torch.randperm(numDialogue, generator=self.generator).numpy()
+        else:
+            order = np.arange(numDialogue)
+        batches = []
+        for start in range(0, numDialogue, self.poolSize):
+            pool = order[start:start + self.poolSize]
+            pool = pool[np.argsort(self.costs[pool], kind='stable')]
+            batch, total = [], 0
+            for idx in pool:
+                # a dialogue above the budget still gets a batch of its own
+                if batch and total + self.costs[idx] > self.budget:
+                    batches.append(batch)
+                    batch, total = [], 0
+                batch.append(int(idx))
+                total += self.costs[idx]
+            if batch:
+                batches.append(batch)
+        if self.shuffle:
+            batches = [batches[ii] for ii in torch.randperm(len(batches), generator=self.generator).tolist()]
+        return batches
+
+    def __iter__(self):
+        # the plan of an epoch is drawn once, whether __len__ or __iter__ asks first
+        if self.batches is None:
+            self.batches = self.plan()
+        batches, self.batches = self.batches, None
+        return iter(batches)
+
+    def __len__(self):
+        if self.batches is None:
+            self.batches = self.plan()
+        return len(self.batches)
+
+
+class MissingCollator():
+    """
+    Batches dialogues with dgl.batch and applies the missing masks on the batched graph:
+    ndata["present"] = ndata["oPresent"] without the missing modalities.
+    Compressed features are dequantized on the batch with the (scale, offset) of `quantization`.
+    With resample, the stored masks are replaced by masks drawn for every batch from `generator`
+    at the same missing rate (modality dropout), similarity edges keep the stored masks.
+    """
+    # missing patterns over (text, audio, vision) of genMissMultiModal, weighted by missingProbs
+    patterns = torch.tensor([[0, 0, 0], [0, 0, 1], [0, 1, 0], [1, 0, 0], [0, 1, 1], [1, 1, 0], [1, 0, 1]], dtype=torch.uint8)
+
+    def __init__(self, missing = 0, resample = False, generator = None, quantization = None):
+        self.collator = GraphCollator()
+        self.quantization = quantization
+        self.resample = resample
+        self.generator = generator
+        self.probs = torch.tensor([1.0, 0, 0, 0, 0, 0, 0])
+        if resample and missing > 0:
+            self.probs = missingProbs(missing)
+
+    def collate(self, items):
+        g, labels = self.collator.collate(items)
+        missing = g.ndata["missing"]
+        if self.resample:
+            pick = torch.multinomial(self.probs, g.num_nodes(), replacement=True, generator=self.generator)
+            missing = self.patterns[pick]
+        g.ndata["present"] = g.ndata["oPresent"] * (1 - missing)
+        if self.quantization is not None:
+            for key in ('text', 'audio', 'vision'):
+                g.ndata[key] = dequantize(g.ndata[key], self.quantization[key])
+        return g, labels
+
 
 class Iemocap6_Gcnet_Dataset():
 
-    def __init__(self, path = './IEMOCAP/IEMOCAP_features_raw_6way.pkl', missing = 0, info = None):
+    def __init__(self, path = './IEMOCAP/IEMOCAP_features_raw_6way.pkl', missing = 0, info = None,
+                 edgeType = 1, topK = 10, threshold = 0.0, featureFormat = 'float32'):
         super(Iemocap6_Gcnet_Dataset, self).__init__()
         self.missing = missing
+        self.featureFormat = featureFormat
+        self.edgeType, self.topK, self.threshold = edgeType, topK, threshold
         self.path = path
         self.info = info
         self.process()
@@ -239,12 +472,22 @@ class Iemocap6_Gcnet_Dataset():
             tmpLb.extend(videoLabels[v])
 
 
-        name2audio, adim = read_data(self.path, f'./IEMOCAP/features/wav2vec-large-c-UTT')
-        name2text, tdim = read_data(self.path, f'./IEMOCAP/features/deberta-large-4-UTT')
-        name2video, vdim = read_data(self.path, f'./IEMOCAP/features/manet_UTT')
-
-        self.trainSet = IEMOCAP6DGL_GCNET(self.trainVids, videoIDs, videoLabels, name2audio, name2text, name2video, self.missing)
-        self.testSet = IEMOCAP6DGL_GCNET(self.testVids, videoIDs, videoLabels, name2audio, name2text, name2video, self.missing)
+        quantization = None
+        if self.featureFormat == 'float32':
+            name2audio, adim = read_data(self.path, FEATURE_ROOT['audio'])
+            name2text, tdim = read_data(self.path, FEATURE_ROOT['text'])
+            name2video, vdim = read_data(self.path, FEATURE_ROOT['vision'])
+        else:
+            # compact codes written by compressFeatures.py
+            name2audio, adim, audioQ = read_compressed(FEATURE_ROOT['audio'], self.featureFormat)
+            name2text, tdim, textQ = read_compressed(FEATURE_ROOT['text'], self.featureFormat)
+            name2video, vdim, videoQ = read_compressed(FEATURE_ROOT['vision'], self.featureFormat)
+            quantization = {'text': textQ, 'audio': audioQ, 'vision': videoQ}
+
+        self.trainSet = IEMOCAP6DGL_GCNET(self.trainVids, videoIDs, videoLabels, videoSpeakers, name2audio, name2text, name2video, self.missing,
+                                          self.edgeType, self.topK, self.threshold, quantization)
+        self.testSet = IEMOCAP6DGL_GCNET(self.testVids, videoIDs, videoLabels, videoSpeakers, name2audio, name2text, name2video, self.missing,
+                                         self.edgeType, self.topK, self.threshold, quantization)
 
         self.out_size = len(np.unique(np.asarray(tmpLb)))
 
@@ -0,0 +1,160 @@
+import glob
+import os
+
+import numpy as np
+import torch
+from dgl.dataloading import GraphDataLoader
+
+from ultis import DEVICE
+
+LAYERS = ('fusion', 'gat', 'crossModal')
+
+
+class EmbeddingWriter():
+    """Buffers rows per name and streams them to outDir/{name}_{chunk:05d}.npy every chunkSize rows."""
+    def __init__(self, outDir, chunkSize = 50000):
+        self.outDir = outDir
+        self.chunkSize = chunkSize
+        self.buffers = {}
+        self.numChunk = {}
+        os.makedirs(outDir, exist_ok=True)
+
+    def add(self, name, rows):
+        self.buffers.setdefault(name, []).append(rows)
+        if sum(len(xx) for xx in self.buffers[name]) >= self.chunkSize:
+            self.flush(name)
+
+    def flush(self, name):
+        if len(self.buffers.get(name, [])) == 0:
+            return
+        chunk = self.numChunk.get(name, 0)
+        np.save(os.path.join(self.outDir, f'{name}_{chunk:05d}.npy'), np.concatenate(self.buffers[name]))
+        self.numChunk[name] = chunk + 1
+        self.buffers[name] = []
+
+    def close(self):
+        for name in list(self.buffers):
+            self.flush(name)
+
+
+def exportEmbeddings(dataloader, model, numLB, outDir, layers = LAYERS, chunkSize = 50000, device = DEVICE):
+    """
+    Batched inference pass that streams the chosen intermediate representations of GAT_FP to disk,
+    together with labels and predictions. Padding nodes are dropped.
+    """
+    model.eval()
+    model.captureEmbedding = True
+    writer = EmbeddingWriter(outDir, chunkSize)
+    for batch in dataloader:
+        g, _ = batch
+        g = g.to(device)
+        with torch.no_grad():
+            pred = model(g)
+        labels = g.ndata["label"].long()
+        keep = labels != numLB
+        for name in layers:
+            if name in model.embeddings:
+                writer.add(name, model.embeddings[name][keep].float().cpu().numpy())
+        writer.add('label', labels[keep].cpu().numpy())
+        writer.add('pred', torch.argmax(pred, 1)[keep].cpu().numpy())
+    writer.close()
+    model.captureEmbedding = False
+    model.embeddings = {}
+
+
+def chunkFiles(outDir, name):
+    return sorted(glob.glob(os.path.join(outDir, f'{name}_[0-9][0-9][0-9][0-9][0-9].npy')))
+
+
+def loadEmbeddings(outDir, name, maxPoints = None, seed = 1001):
+    """Memory-maps the chunks of `name`, optionally keeping a uniform random subsample of maxPoints rows."""
+    chunks = [np.load(path, mmap_mode='r') for path in chunkFiles(outDir, name)]
+    total = sum(len(chunk) for chunk in chunks)
+    if maxPoints is None or maxPoints >= total:
+        return np.concatenate(chunks), np.arange(total)
+    index = np.sort(np.random.default_rng(seed).choice(total, maxPoints, replace=False))
+    rows, offset = [], 0
+    for chunk in chunks:
+        local = index[(index >= offset) & (index < offset + len(chunk))] - offset
+        rows.append(np.asarray(chunk[local]))
+        offset += len(chunk)
+    return np.concatenate(rows), index
+
+
+def project2D(embeddings, maxPoints = 20000, pcaDim = 50, neighbors = 10, seed = 1001):
+    """
+    Scalable 2-D projection: PCA to pcaDim, Barnes-Hut t-SNE with PCA initialisation on at most maxPoints rows,
+    the remaining rows are placed at the mean position of their nearest embedded neighbours.
+    """
+    from sklearn.decomposition import PCA
+    from sklearn.manifold import TSNE
+    from sklearn.neighbors import NearestNeighbors
+
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if embeddings.shape[1] > pcaDim:
+        embeddings = PCA(n_components=pcaDim, svd_solver='randomized', random_state=seed).fit_transform(embeddings)
+    rng = np.random.default_rng(seed)
+    anchor = np.arange(len(embeddings))
+    if len(embeddings) > maxPoints:
+        anchor = np.sort(rng.choice(len(embeddings), maxPoints, replace=False))
+    tsne = TSNE(n_components=2, init='pca', method='barnes_hut', perplexity=min(30, len(anchor) - 1), random_state=seed)
+    transformed = np.zeros((len(embeddings), 2), dtype=np.float32)
+    transformed[anchor] = tsne.fit_transform(embeddings[anchor])
+    if len(anchor) < len(embeddings):
+        rest = np.setdiff1d(np.arange(len(embeddings)), anchor)
+        knn = NearestNeighbors(n_neighbors=min(neighbors, len(anchor))).fit(embeddings[anchor])
+        _, nearest = knn.kneighbors(embeddings[rest])
+        transformed[rest] = transformed[anchor][nearest].mean(axis=1)
+    return transformed
+
+
+def vis(info, savePath = None):
+    print('Visualize')
+    import matplotlib.pyplot as plt
+
+    X0, y0 = info
+    transformed = project2D(X0)
+    y0 = np.asarray(y0)
+    fig, ax = plt.subplots(figsize=(8, 8))
+    for label in np.unique(y0):
+        pos = np.where(y0 == label)
+        ax.scatter(transformed[pos, 0], transformed[pos, 1], s=2, label=str(label))
+    ax.legend(markerscale=5)
+    if savePath:
+        fig.savefig(savePath, dpi=150)
+    else:
+        plt.show()
+
+
+if __name__ == "__main__":
+    from config import buildParser, loadDataset
+    from dataloader import MissingCollator
+    from model import GAT_FP
+    from ultis import seed_everything, seedList
+
+    parser = buildParser()
+    parser.add_argument('--modelPath', help='state dict saved by main.py --saveModel', required=True)
+    parser.add_argument('--embeddingDir', help='directory receiving the embedding chunks', default='./embedding')
+    parser.add_argument('--layers', nargs='+', help='fusion, gat, crossModal', default=list(LAYERS))
+    parser.add_argument('--split', help='train or test', default='test')
+    parser.add_argument('--chunkSize', help='rows per chunk file', default=50000, type=int)
+    parser.add_argument('--maxPoints', help='rows used by the 2-D projection', default=20000, type=int)
+    parser.add_argument('--plot', help='save a 2-D projection of the first layer to this png', default='')
+    args = parser.parse_args()
+
+    setSeed = seedList[0] if args.seed == 'random' else int(args.seed)
+    seed_everything(seed=setSeed)
+    data, numLB = loadDataset(args, {'missing': args.missing, 'seed': setSeed})
+    dataset = data.trainSet if args.split == 'train' else data.testSet
+    loader = GraphDataLoader(dataset=dataset, batch_size=args.batchSize,
+                             collate_fn=MissingCollator(quantization = dataset.quantization).collate)
+
+    model = GAT_FP(data.out_size, args.wFP, args, probality = True)
+    model.load_state_dict(torch.load(args.modelPath, map_location=DEVICE))
+    model = model.to(DEVICE)
+    exportEmbeddings(loader, model, numLB, args.embeddingDir, args.layers, args.chunkSize)
+    print(f'Embeddings {args.layers} written to {args.embeddingDir}')
+    if args.plot:
+        X0, index = loadEmbeddings(args.embeddingDir, args.layers[0], args.maxPoints, setSeed)
+        y0, _ = loadEmbeddings(args.embeddingDir, 'label')
+        vis([X0, y0[index]], args.plot)
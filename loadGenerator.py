@@ -0,0 +1,88 @@
+"""
+Load generator for serve.py.
+--concurrency connections send --requests synthetic dialogues in total (utterance count uniform in
+[--minLen, --maxLen], random features of the dims reported by the server, --missingRate of the modalities missing)
+and report throughput, client latency percentiles and the server stats.
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import numpy as np
+
+LINE_LIMIT = 2**26
+
+
+async def connect(args):
+    if args.socket:
+        return await asyncio.open_unix_connection(args.socket, limit=LINE_LIMIT)
+    return await asyncio.open_connection(args.host, args.port, limit=LINE_LIMIT)
+
+
+async def call(reader, writer, line):
+    writer.write(line)
+    await writer.drain()
+    return json.loads(await reader.readline())
+
+
+def dialoguePool(args, dims):
+    # requests are encoded once so the client does not compete with the server for CPU
+    rng = np.random.default_rng(args.seed)
+    pool = []
+    for _ in range(args.pool):
+        numNode = int(rng.integers(args.minLen, args.maxLen + 1))
+        request = {'speakers': rng.choice(['M', 'F'], numNode).tolist(),
+                   'missing': (rng.random((numNode, 3)) < args.missingRate).astype(int).tolist()}
+        for key, dim in dims.items():
+            request[key] = rng.standard_normal((numNode, dim)).astype(np.float32).round(4).tolist()
+        pool.append(json.dumps(request)[1:])
+    return pool
+
+
+async def client(args, pool, ids, latency, errors):
+    reader, writer = await connect(args)
+    for idx in ids:
+        line = f'{{"id": {idx}, {pool[idx % len(pool)]}\n'.encode()
+        start = time.perf_counter()
+        response = await call(reader, writer, line)
+        latency.append(time.perf_counter() - start)
+        if 'error' in response:
+            errors.append(response['error'])
+    writer.close()
+
+
+async def run(args):
+    reader, writer = await connect(args)
+    stats = await call(reader, writer, b'{"cmd": "stats"}\n')
+    pool = dialoguePool(args, stats['dims'])
+    ids = iter(range(args.requests))
+    latency, errors = [], []
+    start = time.perf_counter()
+    await asyncio.gather(*[client(args, pool, ids, latency, errors) for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+    stats = await call(reader, writer, b'{"cmd": "stats"}\n')
+    writer.close()
+
+    latency = np.asarray(latency) * 1000
+    print(f'{len(latency)} dialogues in {elapsed:.2f}s, {len(latency) / elapsed:.1f} dialogues/s, {len(errors)} errors')
+    print('Client latency (ms) p50 {:.2f} p95 {:.2f} p99 {:.2f}'.format(*np.percentile(latency, [50, 95, 99])))
+    print('Server latency (ms) p50 {p50:.2f} p95 {p95:.2f} p99 {p99:.2f} | mean batch {meanBatch:.1f} | queue {queue}'.format(**stats))
+    if errors:
+        print(f'First error: {errors[0]}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', help='TCP host of serve.py', default='127.0.0.1')
+    parser.add_argument('--port', help='TCP port of serve.py', default=8765, type=int)
+    parser.add_argument('--socket', help='Unix socket of serve.py instead of TCP', default='')
+    parser.add_argument('--concurrency', help='concurrent connections', default=32, type=int)
+    parser.add_argument('--requests', help='dialogues sent in total', default=1000, type=int)
+    parser.add_argument('--minLen', help='fewest utterances per dialogue', default=10, type=int)
+    parser.add_argument('--maxLen', help='most utterances per dialogue', default=60, type=int)
+    parser.add_argument('--missingRate', help='probability that a modality of an utterance is missing', default=0.3, type=float)
+    parser.add_argument('--pool', help='distinct synthetic dialogues', default=64, type=int)
+    parser.add_argument('--seed', help='seed of the synthetic dialogues', default=1001, type=int)
+    args = parser.parse_args()
+    asyncio.run(run(args))
@@ -1,270 +1,243 @@
-import argparse
+import os
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
 
-import dgl
-import dgl.nn as dglnn
-from dgl import AddSelfLoop
-from dgl.nn import LabelPropagation
-from dgl.data import CiteseerGraphDataset, CoraGraphDataset, PubmedGraphDataset
-from dataloader import *
-from sklearn.metrics import f1_score
-from torch.utils.data import DataLoader
 # torch.set_default_dtype(torch.float)
 import warnings
 warnings.filterwarnings("ignore", category=UserWarning)
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-import networkx as nx
 from dgl.dataloading import GraphDataLoader
-from tqdm import tqdm
-from attentionModule import *
-from dgl.nn import GraphConv, SumPooling, AvgPooling
-DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-from torch.nn import init
+from config import buildParser, loadDataset
+from dataloader import LengthBucketBatchSampler, MissingCollator
+from model import GAT_FP, ensembleForward
+from ultis import DEVICE, EvalScheduler, FocalLoss, classWeight, evaluate, evaluateEnsemble, progress, seed_everything, seedList
 
 
-def checkMissing(data):
-    if len(np.where(data==0)[0]) > 0:
-        return True
-    return False
+def buildLoss(info, trainSet, numLB):
+    weight = None
+    if info['classWeight']:
+        weight = classWeight(trainSet.listLabel(), numLB)
+    if info['loss'] == 'focal':
+        return FocalLoss(gamma = info['gamma'], alpha = weight, reduction = info['lossReduction'])
+    if info['loss'] != 'ce':
+        raise ValueError(f"unknown loss {info['loss']}, expected ce or focal")
+    return nn.CrossEntropyLoss(weight = weight, reduction = info['lossReduction'])
 
-class maskFilter(nn.Module):
-    def __init__(self, in_size):
-        super().__init__()
-        tt, aa, vv  = 64, 128, 192
-        # self.testM = nn.Parameter(torch.rand(in_size, in_size))
-        currentFeatures = np.asarray([0.0] * in_size)
-        textMask = np.copy(currentFeatures)
-        textMask[:tt] = 1.0
-        audioMask = np.copy(currentFeatures)
-        audioMask[tt: aa] = 1.0
-        videoMask = np.copy(currentFeatures)
-        videoMask[aa:] = 1.0
-        self.textMask = torch.from_numpy(textMask) * torch.tensor(3.0)
-        self.textMask = nn.Parameter(self.textMask).float().to(DEVICE)
-        
-        self.audioMask = torch.from_numpy(audioMask) * torch.tensor(2.0)
-        self.audioMask = nn.Parameter(self.audioMask).float().to(DEVICE)
-        
-        self.videoMask = torch.from_numpy(videoMask) * torch.tensor(1.0)
-        self.videoMask = nn.Parameter(self.videoMask).float().to(DEVICE)
 
+def batchLoss(model, g, labels, pos, loss_fcn, loss_imput, info, logits = None):
+    if logits is None:
+        logits = model(g)
+    logits = logits[pos]
+    # loss = loss_fcn(logits, labels)
+    if info['reconstructionLoss'] == 'mse':
+        data_mse, odata = model.mseLoss()
+        loss = loss_fcn(logits, labels) + (info['missing']) * 0.01 * loss_imput(data_mse, odata)
+    elif (info['reconstructionLoss'] == 'kl') and (int(info['rho']) != -1):
+        loss = loss_fcn(logits, labels) + (info['missing']) * 0.01 * model.rho_loss(float(info['rho']))
+        # loss = (100 - info['missing']) * 0.01 * loss_fcn(logits, labels) + (info['missing']) * 0.01 * model.rho_loss(float(info['rho']))
+    else:
+        loss = loss_fcn(logits, labels)
+    return loss
 
-    def forward(self, features):
-        return features * self.textMask + features * self.audioMask + features * self.videoMask
 
-    def string(self):
-        """
-        Just like any class in Python, you can also define custom method on PyTorch modules
-        """
-        return f'y = {self.textMask.item()} + {self.audioMask.item()} + {self.videoMask.item()}'
+def evalEpoch(info, epoch):
+    # every evalEvery epochs and always after the last one
+    return (epoch + 1) % info['evalEvery'] == 0 or epoch == info['numEpoch'] - 1
 
-class GAT_FP(nn.Module):
-    def __init__(self, out_size, wFP, probality = False):
-        super().__init__()
-        self.audioEncoder = nn.Linear(512, 64).to(torch.float64)
-        self.dropAudio = nn.Dropout(0.5)
-        self.visionEncoder = nn.Linear(1024, 64).to(torch.float64)
-        self.dropVision = nn.Dropout(0.5)
-        self.textEncoder = nn.Linear(1024, 64).to(torch.float64)
-        self.in_size = 192
-        self.outMMEncoder = 8
-        # <40 self.outMMencoder = 4
-        self.MMEncoder = nn.LSTM(self.in_size, self.outMMEncoder, bidirectional = True).to(torch.float64)
-        gcv = [self.in_size, 32, 4]
-        self.maskFilter = maskFilter(self.in_size)
-        self.num_heads = 4
-        self.imputationModule = dglnn.GraphConv(self.in_size,  self.in_size, norm = 'both')
-        self.decodeModule = nn.Linear(self.in_size, self.in_size)
-        self.gat1 = nn.ModuleList()
-        if args.usingGAT:
-            # two-layer GCN
-            for ii in range(len(gcv)-1):
-                self.gat1.append(
-                    dglnn.GATv2Conv(np.power(self.num_heads, ii) * gcv[ii],  gcv[ii+1], activation=F.relu,  residual=True, num_heads = self.num_heads)
-                )
-        else:
-            self.gat1.append(nn.Linear(self.in_size,  self.num_heads * gcv[-1]))
-        coef = 1
-        self.gat2 = MultiHeadGATCrossModal(self.in_size,  gcv[-1], num_heads = self.num_heads)
-        if args.crossModal:            
-            self.linear = nn.Linear(self.num_heads * 4 * 2 + self.outMMEncoder * 2, out_size).to(torch.float64)
-        else:
-            self.linear = nn.Linear(self.num_heads * 4 + self.outMMEncoder * 2, out_size).to(torch.float64)
-        # self.linear = nn.Linear(gcv[-1] * self.num_heads * 7, out_size)
-        self.dropout = nn.Dropout(0.75)
-        self.probality = probality
-        # self.reset_parameters()
-
-    def featureFusion(self, tf, af, vf):
-        audioOuput = self.audioEncoder(af)
-        audioOuput = self.dropAudio(audioOuput)
-        visionOutput = self.visionEncoder(vf)
-        visionOutput = self.dropVision(visionOutput)
-        textOutput = self.textEncoder(tf)
-        stackFT = torch.hstack([textOutput, audioOuput, visionOutput]).to(torch.float64)
-        newFeature = stackFT.view(-1, 120, self.in_size).to(torch.float64)
-        newFeature = newFeature.permute(1, 0, 2)
-        newFeature, _ = self.MMEncoder(newFeature)
-        newFeature = newFeature.permute(1, 0, 2)
-        newFeature = newFeature.reshape(-1, self.outMMEncoder*2)  
-        return newFeature, stackFT
-
-
-    def forward(self, g):
-        text = g.ndata["text"].to(torch.float64)
-        audio = g.ndata["audio"]
-        audio = audio.to(torch.float64)
-        video = g.ndata["vision"]
-        video = video.to(torch.float64)
-
-        oText = g.ndata["oText"].to(torch.float64)
-        oAudio = g.ndata["oAudio"]
-        oAudio = oAudio.to(torch.float64)
-        oVideo = g.ndata["oVision"]
-        oVideo = oVideo.to(torch.float64)
-
-        newFeature, stackFT = self.featureFusion(text, audio, video)
-        oFeature, oStackFT = self.featureFusion(oText, oAudio, oVideo)
-        h = stackFT.float()
-        if args.featureEstimate == 'FE':
-            h1 = self.imputationModule(g, h)
-            h1 = self.decodeModule(h1)
-        elif args.featureEstimate == 'Mean':
-            raise "Error selected feature Estimation not implemented"
-        elif args.featureEstimate == 'Zero':
-            pass
-        else:
-            raise "Error selected feature Estimation not implemented"
-        h = 0.5 * (h + h1)
-        self.data_mse = h
-        self.odata = oStackFT.float()
-        # h = h + h1
-        h = F.normalize(h, p=1)
-        h = self.maskFilter(h)
-        if args.crossModal:
-            h3 = self.gat2(g, h)
-
-        for i, layer in enumerate(self.gat1):
-            if i != 0:
-                h = self.dropout(h)
-            h = h.float()
-            h = torch.reshape(h, (len(h), -1))
-            if args.usingGAT:
-                h = layer(g, h)
-            else:
-                h = layer(h)
-            if i == 0 and self.probality:
-                self.firstGCN = torch.sigmoid(h)
-                self.data_rho = torch.mean(self.firstGCN.reshape(-1, self.num_heads*32), 0)
-        
-        h = torch.reshape(h, (len(h), -1))
-        if args.crossModal:
-            h = torch.cat((h,newFeature,h3), 1)
-        else:
-            h = torch.cat((h,newFeature), 1)
-        h = self.linear(h)
-        return h
-
-    def reset_parameters(self):
-        self.imputationModule.reset_parameters()
-        for i, layer in enumerate(self.gat1):
-            layer.reset_parameters()
-        init.xavier_uniform_(self.linear.weight, gain=1)
-        nn.init.constant_(self.linear.bias, 0)
-        init.xavier_uniform_(self.audioEncoder.weight, gain=1)
-        nn.init.constant_(self.audioEncoder.bias, 0)
-        init.xavier_uniform_(self.visionEncoder.weight, gain=1)
-        nn.init.constant_(self.visionEncoder.bias, 0)
-        self.textEncoder.reset_parameters()
-        self.MMEncoder.reset_parameters()
 
-    def mseLoss(self):
-        return self.data_mse, self.odata
-
-    def rho_loss(self, rho, size_average=True):
-        dkl = - rho * torch.log(self.data_rho) - (1-rho)*torch.log(1-self.data_rho) # calculates KL divergence
-        if size_average:
-            self._rho_loss = dkl.mean()
-        else:
-            self._rho_loss = dkl.sum()
-        return self._rho_loss
+def alignGenerator(trainLoader, info):
+    # an inline evaluation draws the base seed of the test iterator from the generator shared with the train loader,
+    # the background one has its own generator: draw here instead so the train order is the same in both modes
+    if info['asyncEval']:
+        torch.empty((), dtype=torch.int64).random_(generator=trainLoader.generator)
 
 
 def train(trainLoader, testLoader, model, info, numLB):
     # define train/val samples, loss function and optimizer
-    loss_fcn = nn.CrossEntropyLoss()
+    loss_fcn = buildLoss(info, trainLoader.dataset, numLB).to(DEVICE)
     loss_imput = nn.MSELoss()
     optimizer = torch.optim.Adam(model.parameters(), lr=info['lr'], weight_decay=info['weight_decay'])
     highestAcc = 0
+    scheduler = EvalScheduler(lambda evalModel: evaluate(testLoader, evalModel, numLB), model, info['asyncEval'])
     # training loop
     for epoch in range(info['numEpoch']):
         model.train()
         totalLoss = 0
-        for batch in tqdm(trainLoader):
+        for batch in progress(trainLoader):
             g, labels = batch
             g = g.to(DEVICE)
             labels = g.ndata["label"]
             labels = labels.type(torch.LongTensor)
             labels = labels.to(DEVICE)
-            optimizer.zero_grad()
-            logits = model(g)
-            pos = torch.where(labels != numLB)
+            # padding nodes never reach the loss
+            pos = labels != numLB
             labels = labels[pos]
-            logits = logits[pos]
-            # loss = loss_fcn(logits, labels)
-            if info['reconstructionLoss'] == 'mse':
-                data_mse, odata = model.mseLoss()
-                loss = loss_fcn(logits, labels) + (info['missing']) * 0.01 * loss_imput(data_mse, odata)
-            elif (info['reconstructionLoss'] == 'kl') and (int(info['rho']) != -1):
-                loss = loss_fcn(logits, labels) + (info['missing']) * 0.01 * model.rho_loss(float(info['rho']))
-                # loss = (100 - info['missing']) * 0.01 * loss_fcn(logits, labels) + (info['missing']) * 0.01 * model.rho_loss(float(info['rho']))
-            else:
-                loss = loss_fcn(logits, labels)
-
+            optimizer.zero_grad()
+            loss = batchLoss(model, g, labels, pos, loss_fcn, loss_imput, info)
             totalLoss += loss.item()
             loss.backward()
             optimizer.step()
         acc  = -1
-        acctest = evaluate(testLoader, model, numLB)
-        print(
-            "Epoch {:05d} | Loss {:.4f} | Accuracy_test {:.4f} ".format(
-                epoch, totalLoss, acctest
+        if evalEpoch(info, epoch):
+            scheduler.submit(epoch, totalLoss, model)
+            alignGenerator(trainLoader, info)
+        else:
+            scheduler.submit(epoch, totalLoss)
+        for doneEpoch, doneLoss, acctest in scheduler.collect(wait = epoch == info['numEpoch'] - 1):
+            if acctest is None:
+                print("Epoch {:05d} | Loss {:.4f} ".format(doneEpoch, doneLoss))
+                continue
+            print(
+                "Epoch {:05d} | Loss {:.4f} | Accuracy_test {:.4f} ".format(
+                    doneEpoch, doneLoss, acctest
+                )
             )
-        )
-        highestAcc = max(highestAcc, acctest)
+            highestAcc = max(highestAcc, acctest)
+    scheduler.close()
 
     return highestAcc
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
 
-    parser.add_argument('--E', help='number of epochs', default=50, type=int)
-    parser.add_argument('--seed', help='type of seed: random vs fix', default='random')
-    parser.add_argument('--lr', help='learning rate', default=0.003, type=float)
-    parser.add_argument('--rho', help='probality default', default=-1.0, type=float)
-    parser.add_argument('--weight_decay', help='weight decay', default=0.00001, type=float)
-    parser.add_argument('--edgeType', help='type of edge:0 for similarity and 1 for other', default=0, type=int)
-    parser.add_argument('--missing', help='percentage of missing utterance in MM data', default=0, type=int)
-    parser.add_argument('--wFP', action='store_true', default=False, help='edge direction type')
-    parser.add_argument('--numTest', help='number of test', default=10, type=int)
-    parser.add_argument('--batchSize', help='size of batch', default=64, type=int)
-    parser.add_argument('--log', action='store_true', default=True, help='save experiment info in output')
-    parser.add_argument('--output', help='savedFile', default='./log_v2.txt')
-    parser.add_argument('--prePath', help='prepath to directory contain DGL files', default='.')
-    parser.add_argument('--numLabel', help='4label vs 6label', default='6')
-    parser.add_argument('--featureEstimate', help='Zero, Mean, FE', default='FE')
-    parser.add_argument('--crossModal',action='store_true', default=False, help='using crossModal')
-    parser.add_argument('--usingGAT',action='store_true', default=False, help='using GAT')
-    parser.add_argument('--reconstructionLoss', 
-        help='mse, kl, none. unless set rho number for kl loss, using none loss instead',
-        default='none')
-    parser.add_argument( "--dataset",
-        type=str,
-        default="IEMOCAP",
-        help="Dataset name ('IEMOCAP', 'MELD').",
-    )
+
+def trainEnsemble(trainLoader, testLoader, models, info, numLB):
+    """
+    Trains the seed members of an ensemble in lockstep: every batch is loaded, collated and moved to the device once,
+    the members run one batched forward (ensembleForward) and one backward of the summed losses.
+    Adam is elementwise, so a single optimizer over all members steps each one as its own would.
+    Returns the highest test F1 of every member and of the ensemble (mean of the member probabilities).
+    """
+    loss_fcn = buildLoss(info, trainLoader.dataset, numLB).to(DEVICE)
+    loss_imput = nn.MSELoss()
+    members = nn.ModuleList(models)
+    optimizer = torch.optim.Adam(members.parameters(), lr=info['lr'], weight_decay=info['weight_decay'])
+    highestAcc = [0] * len(models)
+    highestEnsemble = 0
+    scheduler = EvalScheduler(lambda evalMembers: evaluateEnsemble(testLoader, list(evalMembers), numLB), members, info['asyncEval'])
+    for epoch in range(info['numEpoch']):
+        for model in models:
+            model.train()
+        totalLoss = [0] * len(models)
+        for batch in progress(trainLoader):
+            g, labels = batch
+            g = g.to(DEVICE)
+            labels = g.ndata["label"]
+            labels = labels.type(torch.LongTensor)
+            labels = labels.to(DEVICE)
+            pos = labels != numLB
+            labels = labels[pos]
+            optimizer.zero_grad()
+            losses = [batchLoss(model, g, labels, pos, loss_fcn, loss_imput, info, logits)
+                      for model, logits in zip(models, ensembleForward(models, g))]
+            for idx, loss in enumerate(losses):
+                totalLoss[idx] += loss.item()
+            torch.stack(losses).sum().backward()
+            optimizer.step()
+        if evalEpoch(info, epoch):
+            scheduler.submit(epoch, totalLoss, members)
+            alignGenerator(trainLoader, info)
+        else:
+            scheduler.submit(epoch, totalLoss)
+        for doneEpoch, doneLoss, result in scheduler.collect(wait = epoch == info['numEpoch'] - 1):
+            if result is None:
+                print("Epoch {:05d} | Loss {} ".format(doneEpoch, ' '.join(f'{xx:.4f}' for xx in doneLoss)))
+                continue
+            acctest, accEnsemble = result
+            print(
+                "Epoch {:05d} | Loss {} | Accuracy_test {} | Ensemble {:.4f} ".format(
+                    doneEpoch, ' '.join(f'{xx:.4f}' for xx in doneLoss), ' '.join(f'{xx:.4f}' for xx in acctest), accEnsemble
+                )
+            )
+            highestAcc = [max(xx, yy) for xx, yy in zip(highestAcc, acctest)]
+            highestEnsemble = max(highestEnsemble, accEnsemble)
+    scheduler.close()
+
+    return highestAcc, highestEnsemble
+
+
+def buildLoaders(args, data, setSeed):
+    trainSet, testSet = data.trainSet, data.testSet
+    g = torch.Generator()
+    g.manual_seed(setSeed)
+    maskGenerator = torch.Generator()
+    maskGenerator.manual_seed(setSeed)
+    # a background evaluation must not draw from the generator of the train loader while it shuffles
+    testGenerator = g
+    if args.asyncEval:
+        testGenerator = torch.Generator()
+        testGenerator.manual_seed(setSeed)
+    trainCollate = MissingCollator(args.missing, args.resampleMissing, maskGenerator, trainSet.quantization).collate
+    testCollate = MissingCollator(quantization = testSet.quantization).collate
+
+    if args.batchBudget > 0:
+        trainSampler = LengthBucketBatchSampler.fromDataset(trainSet, args.batchBudget, args.budgetUnit, generator=g)
+        testSampler = LengthBucketBatchSampler.fromDataset(testSet, args.batchBudget, args.budgetUnit, shuffle=False)
+        trainLoader = GraphDataLoader(dataset=trainSet, batch_sampler=trainSampler, generator=g, collate_fn=trainCollate)
+        testLoader = GraphDataLoader(dataset=testSet, batch_sampler=testSampler, generator=testGenerator, collate_fn=testCollate)
+    else:
+        trainLoader = GraphDataLoader(  dataset=trainSet, 
+                                        batch_size=args.batchSize, 
+                                        shuffle=True, 
+                                        generator=g,
+                                        collate_fn=trainCollate)
+        testLoader = GraphDataLoader(   dataset=testSet, 
+                                        batch_size=args.batchSize,
+                                        generator=testGenerator,
+                                        collate_fn=testCollate)
+    return trainLoader, testLoader
+
+
+def newModel(args, out_size):
+    model = GAT_FP(out_size, args.wFP, args, probality = True)
+    for layer in model.children():
+       if hasattr(layer, 'reset_parameters'):
+           layer.reset_parameters()
+    return model.to(DEVICE)
+
+
+def memberSeed(args, test):
+    if args.seed == 'random':
+        return seedList[test]
+    if args.ensemble:
+        # members of a fixed seed ensemble still need distinct initialisations
+        return int(args.seed) + test
+    return int(args.seed)
+
+
+def runEnsemble(args, info):
+    seeds = [memberSeed(args, test) for test in range(args.numTest)]
+    seed_everything(seed=seeds[0])
+    info['seed'] = seeds
+    if args.log:
+        sourceFile = open(args.output, 'a')
+        print('*'*10, 'INFO' ,'*'*10, file = sourceFile)
+        print(info, file = sourceFile)
+        sourceFile.close()
+
+    # one dataset, missing masks and batch order shared by every member
+    data, numLB = loadDataset(args, info)
+    trainLoader, testLoader = buildLoaders(args, data, seeds[0])
+    models = []
+    for setSeed in seeds:
+        seed_everything(seed=setSeed)
+        models.append(newModel(args, data.out_size))
+    seed_everything(seed=seeds[0])
+    print(f"Training an ensemble of {len(models)} members...")
+    highestAcc, highestEnsemble = trainEnsemble(trainLoader, testLoader, models, info, numLB)
+    acc, accEnsemble = evaluateEnsemble(testLoader, models, numLB)
+    print("Final Test accuracy {} | Ensemble {:.4f}".format(' '.join(f'{xx:.4f}' for xx in acc), accEnsemble))
+    if args.saveModel:
+        root, ext = os.path.splitext(args.saveModel)
+        for setSeed, model in zip(seeds, models):
+            torch.save(model.state_dict(), f'{root}_{setSeed}{ext}')
+    if args.log:
+        sourceFile = open(args.output, 'a')
+        for setSeed, highest, final in zip(seeds, highestAcc, acc):
+            print(f'Seed {setSeed} Highest Acc: {highest}, final Acc {final}', file = sourceFile)
+        print(f'Ensemble Highest Acc: {highestEnsemble}, final Acc {accEnsemble}', file = sourceFile)
+        print('*'*10, 'End' ,'*'*10, file = sourceFile)
+        sourceFile.close()
+
+
+if __name__ == "__main__":
+    parser = buildParser()
     args = parser.parse_args()
     print(f"Training with DGL built-in GraphConv module.")
     torch.cuda.empty_cache()
@@ -273,64 +246,64 @@ if __name__ == "__main__":
             'lr': args.lr, 
             'weight_decay': args.weight_decay,
             'missing': args.missing,
+            'featureFormat': args.featureFormat,
+            'resampleMissing': args.resampleMissing,
             'seed': args.seed,
             'numTest': args.numTest,
+            'evalEvery': args.evalEvery,
+            'asyncEval': args.asyncEval,
+            'ensemble': args.ensemble,
             'wFP': args.wFP,
             'numLabel': args.numLabel,
             'reconstructionLoss': args.reconstructionLoss,
             'featureEstimate': args.featureEstimate,
             'crossModal': args.crossModal,
+            'graphCrossModal': args.graphCrossModal,
             'usingGAT': args.usingGAT,
-            'rho': args.rho
+            'rho': args.rho,
+            'edgeType': args.edgeType,
+            'simTopK': args.simTopK,
+            'simThreshold': args.simThreshold,
+            'loss': args.loss,
+            'gamma': args.gamma,
+            'classWeight': args.classWeight,
+            'lossReduction': args.lossReduction
         }
-    for test in range(args.numTest):
-        if args.seed == 'random':
-            setSeed = seedList[test]
+    if args.ensemble:
+        runEnsemble(args, info)
+    else:
+        for test in range(args.numTest):
+            setSeed = memberSeed(args, test)
+            seed_everything(seed=setSeed)
             info['seed'] = setSeed
-        else:
-            setSeed = int(args.seed)
-        seed_everything(seed=setSeed)
-        info['seed'] = setSeed
-        if args.log:
-            sourceFile = open(args.output, 'a')
-            print('*'*10, 'INFO' ,'*'*10, file = sourceFile)
-            print(info, file = sourceFile)
-            sourceFile.close()
-                 
-        numLB = 6
-        if args.numLabel =='4':
-            numLB = 4
-        dataPath  = f'./IEMOCAP/IEMOCAP_features_raw_{numLB}way.pkl'
-        data = Iemocap6_Gcnet_Dataset(missing = args.missing, path = dataPath, info = info)
-        trainSet, testSet = data.trainSet, data.testSet
-        g = torch.Generator()
-        g.manual_seed(setSeed)
+            if args.log:
+                sourceFile = open(args.output, 'a')
+                print('*'*10, 'INFO' ,'*'*10, file = sourceFile)
+                print(info, file = sourceFile)
+                sourceFile.close()
 
-        trainLoader = GraphDataLoader(  dataset=trainSet, 
-                                        batch_size=args.batchSize, 
-                                        shuffle=True, 
-                                        generator=g)
-        testLoader = GraphDataLoader(   dataset=testSet, 
-                                        batch_size=args.batchSize,
-                                        generator=g)
+            data, numLB = loadDataset(args, info)
+            trainLoader, testLoader = buildLoaders(args, data, setSeed)
 
-        # create GCN model
-        out_size = data.out_size 
-        model = GAT_FP(out_size, args.wFP, probality = True)
-        for layer in model.children():
-           if hasattr(layer, 'reset_parameters'):
-               layer.reset_parameters()
-        model = model.to(DEVICE)
-        print(model)
-        # model training
-        print("Training...")
-        highestAcc = train(trainLoader, testLoader, model, info, numLB)
-        # test the model
-        print("Testing...")
-        acc = evaluate(testLoader, model, numLB)
-        print("Final Test accuracy {:.4f}".format(acc))
-        if args.log:
-            sourceFile = open(args.output, 'a')
-            print(f'Highest Acc: {highestAcc}, final Acc {acc}', file = sourceFile)
-            print('*'*10, 'End' ,'*'*10, file = sourceFile)
-            sourceFile.close()
\ No newline at end of file
+            # create GCN model
+            out_size = data.out_size 
+            model = newModel(args, out_size)
+            print(model)
+            # model training
+            print("Training...")
+            highestAcc = train(trainLoader, testLoader, model, info, numLB)
+            # test the model
+            print("Testing...")
+            acc = evaluate(testLoader, model, numLB)
+            print("Final Test accuracy {:.4f}".format(acc))
+            if args.saveModel:
+                savePath = args.saveModel
+                if args.numTest > 1:
+                    root, ext = os.path.splitext(savePath)
+                    savePath = f'{root}_{setSeed}{ext}'
+                torch.save(model.state_dict(), savePath)
+            if args.log:
+                sourceFile = open(args.output, 'a')
+                print(f'Highest Acc: {highestAcc}, final Acc {acc}', file = sourceFile)
+                print('*'*10, 'End' ,'*'*10, file = sourceFile)
+                sourceFile.close()
\ No newline at end of file
@@ -0,0 +1,353 @@
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import dgl.nn as dglnn
+from torch.nn import init
+
+from attentionModule import MultiHeadGATCrossModal, MultiHeadGraphCrossModal
+
+
+def checkMissing(data):
+    if len(np.where(data==0)[0]) > 0:
+        return True
+    return False
+
+class maskFilter(nn.Module):
+    def __init__(self, in_size):
+        super().__init__()
+        tt, aa, vv  = 64, 128, 192
+        # self.testM = nn.Parameter(torch.rand(in_size, in_size))
+        currentFeatures = np.asarray([0.0] * in_size)
+        textMask = np.copy(currentFeatures)
+        textMask[:tt] = 1.0
+        audioMask = np.copy(currentFeatures)
+        audioMask[tt: aa] = 1.0
+        videoMask = np.copy(currentFeatures)
+        videoMask[aa:] = 1.0
+        # buffers so the masks follow the model across devices (e.g. CPU inference)
+        self.register_buffer('textMask', (torch.from_numpy(textMask) * torch.tensor(3.0)).float())
+        self.register_buffer('audioMask', (torch.from_numpy(audioMask) * torch.tensor(2.0)).float())
+        self.register_buffer('videoMask', (torch.from_numpy(videoMask) * torch.tensor(1.0)).float())
+
+
+    def forward(self, features):
+        return features * self.textMask + features * self.audioMask + features * self.videoMask
+
+    def string(self):
+        """
+        Just like any class in Python, you can also define custom method on PyTorch modules
+        """
+        return f'y = {self.textMask.item()} + {self.audioMask.item()} + {self.videoMask.item()}'
+
+class GAT_FP(nn.Module):
+    def __init__(self, out_size, wFP, args, probality = False):
+        super().__init__()
+        self.args = args
+        # working precision of the encoders, float32 once the model is quantized
+        self.dtype = torch.float64
+        self.audioEncoder = nn.Linear(512, 64).to(torch.float64)
+        self.dropAudio = nn.Dropout(0.5)
+        self.visionEncoder = nn.Linear(1024, 64).to(torch.float64)
+        self.dropVision = nn.Dropout(0.5)
+        self.textEncoder = nn.Linear(1024, 64).to(torch.float64)
+        self.in_size = 192
+        self.outMMEncoder = 8
+        # <40 self.outMMencoder = 4
+        self.MMEncoder = nn.LSTM(self.in_size, self.outMMEncoder, bidirectional = True).to(torch.float64)
+        gcv = [self.in_size, 32, 4]
+        self.maskFilter = maskFilter(self.in_size)
+        self.num_heads = 4
+        self.imputationModule = dglnn.GraphConv(self.in_size,  self.in_size, norm = 'both')
+        self.decodeModule = nn.Linear(self.in_size, self.in_size)
+        self.gat1 = nn.ModuleList()
+        if self.args.usingGAT:
+            # two-layer GCN
+            for ii in range(len(gcv)-1):
+                self.gat1.append(
+                    dglnn.GATv2Conv(np.power(self.num_heads, ii) * gcv[ii],  gcv[ii+1], activation=F.relu,  residual=True, num_heads = self.num_heads)
+                )
+        else:
+            self.gat1.append(nn.Linear(self.in_size,  self.num_heads * gcv[-1]))
+        coef = 1
+        if self.args.graphCrossModal:
+            self.gat2 = MultiHeadGraphCrossModal(self.in_size,  gcv[-1], num_heads = self.num_heads)
+        else:
+            self.gat2 = MultiHeadGATCrossModal(self.in_size,  gcv[-1], num_heads = self.num_heads)
+        if self.args.crossModal:            
+            self.linear = nn.Linear(self.num_heads * 4 * 2 + self.outMMEncoder * 2, out_size).to(torch.float64)
+        else:
+            self.linear = nn.Linear(self.num_heads * 4 + self.outMMEncoder * 2, out_size).to(torch.float64)
+        # self.linear = nn.Linear(gcv[-1] * self.num_heads * 7, out_size)
+        self.dropout = nn.Dropout(0.75)
+        self.probality = probality
+        # keep the intermediate representations of the last forward in self.embeddings, see embedding.py
+        self.captureEmbedding = False
+        # self.reset_parameters()
+
+    def encode(self, encoder, features, present, oPresent = None):
+        # only rows holding the modality go through the encoder, the others get its output for a zero input;
+        # with oPresent the unmasked output is built from the same pass over the oPresent rows
+        widest = present if oPresent is None else oPresent
+        index = torch.nonzero(widest, as_tuple=True)[0]
+        zeroOutput = encoder(features.new_zeros(1, features.shape[1], dtype=self.dtype))
+        output = zeroOutput.expand(len(features), -1)
+        if len(index) == 0:
+            return [output.contiguous()] * (1 if oPresent is None else 2)
+        rows = encoder(features[index].to(self.dtype))
+        keep = present[index] > 0
+        outputs = [output.index_copy(0, index[keep], rows[keep])]
+        if oPresent is not None:
+            outputs.append(output.index_copy(0, index, rows))
+        return outputs
+
+    def featureFusion(self, tf, af, vf, present):
+        stackFT = self.encodeModalities(tf, af, vf, present)[0]
+        return self.contextEncode(stackFT), stackFT
+
+    def encodeModalities(self, tf, af, vf, present, oPresent = None):
+        # the masked stack, followed by the unmasked one when oPresent is given
+        audioOuput = self.encode(self.audioEncoder, af, present[:, 1], None if oPresent is None else oPresent[:, 1])
+        visionOutput = self.encode(self.visionEncoder, vf, present[:, 2], None if oPresent is None else oPresent[:, 2])
+        textOutput = self.encode(self.textEncoder, tf, present[:, 0], None if oPresent is None else oPresent[:, 0])
+        return [self.stackModalities(*outputs) for outputs in zip(textOutput, audioOuput, visionOutput)]
+
+    def stackModalities(self, textOutput, audioOuput, visionOutput):
+        audioOuput = self.dropAudio(audioOuput)
+        visionOutput = self.dropVision(visionOutput)
+        return torch.hstack([textOutput, audioOuput, visionOutput]).to(self.dtype)
+
+    def contextEncode(self, stackFT):
+        # MMEncoder LSTM over the 120 padded utterances of every dialogue
+        newFeature = stackFT.view(-1, 120, self.in_size).to(self.dtype)
+        newFeature = newFeature.permute(1, 0, 2)
+        newFeature, _ = self.MMEncoder(newFeature)
+        newFeature = newFeature.permute(1, 0, 2)
+        return newFeature.reshape(-1, self.outMMEncoder*2)
+
+
+    def zeroEstimate(self, g, h):
+        present = g.ndata["present"].to(h.dtype).unsqueeze(-1)
+        return (h.view(len(h), 3, -1) * present).reshape(len(h), -1)
+
+    def meanEstimate(self, g, h):
+        """
+        Missing modality blocks take the mean of the present ones of the same speaker in the dialogue,
+        then of the whole dialogue, zero when the dialogue has none.
+        """
+        block = h.view(len(h), 3, -1)
+        present = g.ndata["present"].to(h.dtype).unsqueeze(-1)
+        graphId = torch.repeat_interleave(torch.arange(g.batch_size, device=h.device), g.batch_num_nodes())
+        numSpeaker = int(g.ndata["speaker"].max()) + 1
+        speakerId = graphId * numSpeaker + g.ndata["speaker"]
+
+        def segmentMean(segment, numSegment):
+            total = h.new_zeros(numSegment, 3, block.shape[-1]).index_add_(0, segment, block * present)
+            count = h.new_zeros(numSegment, 3, 1).index_add_(0, segment, present)
+            return total[segment] / count[segment].clamp(min=1), count[segment]
+
+        speakerMean, speakerCount = segmentMean(speakerId, g.batch_size * numSpeaker)
+        dialogueMean, _ = segmentMean(graphId, g.batch_size)
+        estimate = torch.where(speakerCount > 0, speakerMean, dialogueMean)
+        block = torch.where(present > 0, block, estimate)
+        return block.reshape(len(h), -1)
+
+    def forward(self, g):
+        text = g.ndata["text"]
+        audio = g.ndata["audio"]
+        video = g.ndata["vision"]
+
+        # reconstruction target on the unmasked features, only read by the mse loss (no LSTM pass)
+        oPresent = g.ndata["oPresent"] if self.needsTarget() else None
+        stacks = self.encodeModalities(text, audio, video, g.ndata["present"], oPresent)
+        stackFT = stacks[0]
+        newFeature = self.contextEncode(stackFT)
+        if oPresent is not None:
+            self.odata = stacks[1].float()
+        h = self.estimate(g, stackFT)
+        h3 = None
+        if self.args.crossModal:
+            h3 = self.gat2(g, h)
+        return self.classify(g, h, newFeature, h3)
+
+    def estimate(self, g, stackFT):
+        h = stackFT.float()
+        if self.args.featureEstimate == 'FE':
+            h1 = self.imputationModule(g, h, edge_weight = g.edata["w"] if "w" in g.edata else None)
+            h1 = self.decodeModule(h1)
+            h = 0.5 * (h + h1)
+        elif self.args.featureEstimate == 'Mean':
+            h = self.meanEstimate(g, h)
+        elif self.args.featureEstimate == 'Zero':
+            h = self.zeroEstimate(g, h)
+        else:
+            raise ValueError(f"unknown feature estimation {self.args.featureEstimate}, expected FE, Mean or Zero")
+        self.data_mse = h
+        # h = h + h1
+        h = F.normalize(h, p=1)
+        return self.maskFilter(h)
+
+    def classify(self, g, h, newFeature, h3 = None):
+        for i, layer in enumerate(self.gat1):
+            if i != 0:
+                h = self.dropout(h)
+            h = h.float()
+            h = torch.reshape(h, (len(h), -1))
+            if self.args.usingGAT:
+                h = layer(g, h)
+            else:
+                h = layer(h)
+            if i == 0 and self.probality:
+                self.firstGCN = torch.sigmoid(h)
+                self.data_rho = torch.mean(self.firstGCN.reshape(-1, self.num_heads*32), 0)
+        
+        h = torch.reshape(h, (len(h), -1))
+        if self.captureEmbedding:
+            self.embeddings = {'fusion': newFeature, 'gat': h}
+            if self.args.crossModal:
+                self.embeddings['crossModal'] = h3
+        if self.args.crossModal:
+            h = torch.cat((h,newFeature,h3), 1)
+        else:
+            h = torch.cat((h,newFeature), 1)
+        h = self.linear(h)
+        return h
+
+    def reset_parameters(self):
+        self.imputationModule.reset_parameters()
+        for i, layer in enumerate(self.gat1):
+            layer.reset_parameters()
+        init.xavier_uniform_(self.linear.weight, gain=1)
+        nn.init.constant_(self.linear.bias, 0)
+        init.xavier_uniform_(self.audioEncoder.weight, gain=1)
+        nn.init.constant_(self.audioEncoder.bias, 0)
+        init.xavier_uniform_(self.visionEncoder.weight, gain=1)
+        nn.init.constant_(self.visionEncoder.bias, 0)
+        self.textEncoder.reset_parameters()
+        self.MMEncoder.reset_parameters()
+
+    def needsTarget(self):
+        return self.training and self.args.reconstructionLoss == 'mse'
+
+    def mseLoss(self):
+        return self.data_mse, self.odata
+
+    def rho_loss(self, rho, size_average=True):
+        dkl = - rho * torch.log(self.data_rho) - (1-rho)*torch.log(1-self.data_rho) # calculates KL divergence
+        if size_average:
+            self._rho_loss = dkl.mean()
+        else:
+            self._rho_loss = dkl.sum()
+        return self._rho_loss
+
+
+def encodeMembers(models, name, features, present, oPresent = None):
+    """
+    One modality encoder of every member over the shared rows of the batch: the rows are gathered once for
+    the masked (present) and, when the mse loss needs it, the unmasked (oPresent) pass and go through a single linear with the
+    member weights concatenated. Returns the (member, node, 64) outputs of each pass.
+    """
+    encoders = [getattr(model, name) for model in models]
+    dtype = models[0].dtype
+    widest = present if oPresent is None else oPresent
+    index = torch.nonzero(widest, as_tuple=True)[0]
+    rows = torch.cat((features.new_zeros(1, features.shape[1], dtype=dtype), features[index].to(dtype)))
+    weight = torch.cat([encoder.weight for encoder in encoders])
+    bias = torch.cat([encoder.bias for encoder in encoders])
+    out = F.linear(rows, weight, bias).view(len(rows), len(models), -1).transpose(0, 1)
+    zeroOutput = out[:, :1].expand(-1, len(features), -1)
+    keep = present[index] > 0
+    outputs = [zeroOutput.index_copy(1, index[keep], out[:, 1:][:, keep])]
+    if oPresent is not None:
+        outputs.append(zeroOutput.index_copy(1, index, out[:, 1:]))
+    return outputs
+
+
+def stackedCrossModal(layers, h):
+    """
+    MultiHeadGATCrossModal of every member and head at once, all projections of a modality block are one bmm.
+    h is (member, node, in_dim), the output (member, node, heads * out_dim) matches layer(g, h[m]) of each member.
+    """
+    heads = [head for layer in layers for head in layer.heads]
+    numMember, numHead = len(layers), len(layers[0].heads)
+    first = heads[0]
+    outDim = first.out_dim
+    parts = {'T': h[..., :first.tt], 'A': h[..., first.tt:first.aa], 'V': h[..., first.aa:]}
+
+    def project(part, names):
+        # (member, node, head, outDim) for every projection in names
+        weight = torch.cat([torch.stack([getattr(head, name).weight for head in heads]).view(numMember, numHead * outDim, -1)
+                            for name in names], 1)
+        out = torch.bmm(parts[part], weight.transpose(1, 2))
+        return out.view(numMember, -1, len(names), numHead, outDim).unbind(2)
+
+    def attend(q, k, v):
+        # outDim x outDim attention per node and head as broadcast products
+        score = q.unsqueeze(-1) * k.unsqueeze(-2) / np.sqrt(outDim)
+        score = F.softmax(score, dim=-2)
+        return (score * v.unsqueeze(-2)).sum(-1)
+
+    qT, kT, vT = project('T', ('qMaskT', 'kMaskT', 'vMaskT'))
+    qA, kA, vA, kTA, vTA = project('A', ('qMaskA', 'kMaskA', 'vMaskA', 'kMaskT', 'vMaskT'))
+    qV, kAV, vAV, kTV, vTV = project('V', ('qMaskV', 'kMaskA', 'vMaskA', 'kMaskT', 'vMaskT'))
+    # same query/key/value pairs as crossModal.forward
+    att = torch.cat((attend(qT, kA, vA), attend(qA, kT, vT), attend(qV, kT, vT),
+                     attend(qT, kAV, vAV), attend(qA, kTV, vTV), attend(qV, kTA, vTA)), dim=-1)
+    weight = torch.stack([head.ln.weight for head in heads]).view(numMember, numHead, outDim, -1)
+    bias = torch.stack([head.ln.bias for head in heads]).view(numMember, 1, numHead, outDim)
+    att = torch.einsum('mnhi,mhoi->mnho', att, weight) + bias
+    return att.reshape(numMember, h.shape[1], -1)
+
+
+def contextEncodeMembers(models, stackFT):
+    """
+    MMEncoder of every member as one LSTM with block diagonal weights (gate by gate), so the 120 steps run once
+    for the ensemble. stackFT is (member, row, in_size), returns (member, row, outMMEncoder * 2) like contextEncode.
+    """
+    if not hasattr(torch, 'func'):
+        # functional_call needs torch >= 2.0, one LSTM per member before that
+        return torch.stack([model.contextEncode(stackFT[idx]) for idx, model in enumerate(models)])
+    lstms = [model.MMEncoder for model in models]
+    first = lstms[0]
+    numMember, hidden = len(lstms), first.hidden_size
+    params = {}
+    for name, _ in first.named_parameters():
+        weights = [getattr(lstm, name) for lstm in lstms]
+        if name.startswith('bias'):
+            params[name] = torch.stack(weights).view(numMember, 4, hidden).transpose(0, 1).reshape(-1)
+        else:
+            params[name] = torch.cat([torch.block_diag(*[weight.view(4, hidden, -1)[gate] for weight in weights]) for gate in range(4)])
+    # shape-only module on the meta device, the block diagonal weights are passed to functional_call
+    lstm = nn.LSTM(numMember * first.input_size, numMember * hidden, bidirectional = first.bidirectional,
+                   dtype = stackFT.dtype, device = 'meta')
+    x = stackFT.view(numMember, -1, 120, first.input_size).permute(2, 1, 0, 3)
+    out, _ = torch.func.functional_call(lstm, params, (x.reshape(120, x.shape[1], -1),))
+    out = out.view(120, x.shape[1], -1, numMember, hidden).permute(3, 1, 0, 2, 4)
+    return out.reshape(numMember, stackFT.shape[1], -1)
+
+
+def ensembleForward(models, g):
+    """
+    Forward of the ensemble members on one batch, equivalent to [model(g) for model in models].
+    The modality encoders and the dense cross-modal attention of all members run as batched matmuls over
+    a member dimension, the LSTMs as one block diagonal LSTM, the imputation and the DGL layers run per member.
+    """
+    present = g.ndata["present"]
+    oPresent = g.ndata["oPresent"] if models[0].needsTarget() else None
+    encoded = [encodeMembers(models, name, g.ndata[key], present[:, ii], None if oPresent is None else oPresent[:, ii])
+               for ii, (name, key) in enumerate((('textEncoder', 'text'), ('audioEncoder', 'audio'), ('visionEncoder', 'vision')))]
+    stacks = []
+    for idx, model in enumerate(models):
+        stacks.append(model.stackModalities(*[output[0][idx] for output in encoded]))
+        if oPresent is not None:
+            # the losses only read the unmasked stack, its LSTM output is never used
+            model.odata = model.stackModalities(*[output[1][idx] for output in encoded]).float()
+    features = contextEncodeMembers(models, torch.stack(stacks))
+    hs = [model.estimate(g, stackFT) for model, stackFT in zip(models, stacks)]
+    h3 = [None] * len(models)
+    if models[0].args.crossModal:
+        if isinstance(models[0].gat2, MultiHeadGATCrossModal):
+            h3 = stackedCrossModal([model.gat2 for model in models], torch.stack(hs))
+        else:
+            h3 = [model.gat2(g, h) for model, h in zip(models, hs)]
+    return [model.classify(g, h, newFeature, member3) for model, h, newFeature, member3 in zip(models, hs, features, h3)]
@@ -0,0 +1,99 @@
+import copy
+import io
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from dgl.dataloading import GraphDataLoader
+
+from config import buildParser, loadDataset
+from dataloader import MissingCollator
+from model import GAT_FP
+from ultis import evaluate, seed_everything, seedList
+
+CPU = torch.device("cpu")
+
+
+def quantizeModel(model, withLSTM = False):
+    """
+    int8 dynamic quantization of a trained GAT_FP for CPU inference.
+    Every nn.Linear (modality encoders, decodeModule, Q/K/V projections, GAT fc) is converted,
+    the MMEncoder LSTM only on request: the quantized LSTM steps the 120 positions one by one
+    and is slower than the float32 kernel at this hidden size.
+    The remaining graph modules run in float32.
+    """
+    model = copy.deepcopy(model).to(CPU).float()
+    model.dtype = torch.float32
+    model.eval()
+    layers = {nn.Linear, nn.LSTM} if withLSTM else {nn.Linear}
+    return torch.quantization.quantize_dynamic(model, layers, dtype=torch.qint8)
+
+
+def loadQuantized(path, out_size, args, withLSTM = False):
+    model = quantizeModel(GAT_FP(out_size, args.wFP, args, probality = True), withLSTM)
+    model.load_state_dict(torch.load(path, map_location=CPU))
+    return model
+
+
+def modelSize(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+
+def dialogueLatency(dataset, model, numSample):
+    # one dialogue per forward, as a serving request would be
+    model.eval()
+    loader = GraphDataLoader(dataset=dataset, batch_size=1, collate_fn=MissingCollator(quantization = dataset.quantization).collate)
+    timing = []
+    with torch.no_grad():
+        for idx, (g, _) in enumerate(loader):
+            if idx >= numSample:
+                break
+            g = g.to(CPU)
+            start = time.perf_counter()
+            model(g)
+            timing.append(time.perf_counter() - start)
+    timing = np.asarray(timing) * 1000
+    return np.mean(timing), np.percentile(timing, 50), np.percentile(timing, 95)
+
+
+if __name__ == "__main__":
+    parser = buildParser()
+    parser.add_argument('--modelPath', help='state dict saved by main.py --saveModel', required=True)
+    parser.add_argument('--quantizedPath', help='where to save the int8 state dict', default='./model_int8.pt')
+    parser.add_argument('--quantizeLSTM', action='store_true', default=False, help='also quantize the MMEncoder LSTM')
+    parser.add_argument('--latencySample', help='number of test dialogues used for latency', default=100, type=int)
+    args = parser.parse_args()
+
+    setSeed = seedList[0] if args.seed == 'random' else int(args.seed)
+    seed_everything(seed=setSeed)
+    info = {'missing': args.missing, 'seed': setSeed}
+    data, numLB = loadDataset(args, info)
+    testLoader = GraphDataLoader(dataset=data.testSet, batch_size=args.batchSize,
+                                 collate_fn=MissingCollator(quantization = data.testSet.quantization).collate)
+
+    model = GAT_FP(data.out_size, args.wFP, args, probality = True)
+    model.load_state_dict(torch.load(args.modelPath, map_location=CPU))
+    model = model.to(CPU)
+    qModel = quantizeModel(model, args.quantizeLSTM)
+    torch.save(qModel.state_dict(), args.quantizedPath)
+
+    acc = evaluate(testLoader, model, numLB, device = CPU)
+    qAcc = evaluate(testLoader, qModel, numLB, device = CPU)
+    size, qSize = modelSize(model), modelSize(qModel)
+    latency = dialogueLatency(data.testSet, model, args.latencySample)
+    qLatency = dialogueLatency(data.testSet, qModel, args.latencySample)
+
+    print(f'F1 float {acc:.4f} | int8 {qAcc:.4f} | delta {qAcc - acc:+.4f}')
+    print(f'Size float {size / 1024:.1f}KB | int8 {qSize / 1024:.1f}KB')
+    print('Latency/dialogue (ms) float mean {:.2f} p50 {:.2f} p95 {:.2f}'.format(*latency))
+    print('Latency/dialogue (ms) int8  mean {:.2f} p50 {:.2f} p95 {:.2f}'.format(*qLatency))
+    if args.log:
+        sourceFile = open(args.output, 'a')
+        print('*'*10, 'QUANTIZE' ,'*'*10, file = sourceFile)
+        print(f'model {args.modelPath} -> {args.quantizedPath}', file = sourceFile)
+        print(f'F1 float {acc}, int8 {qAcc}, size {size} -> {qSize}, latency {latency[0]} -> {qLatency[0]}', file = sourceFile)
+        print('*'*10, 'End' ,'*'*10, file = sourceFile)
+        sourceFile.close()
@@ -0,0 +1,204 @@
+"""
+Local inference server for GAT_FP with dynamic micro-batching.
+Clients send one dialogue per JSON line over TCP (or a Unix socket with --socket):
+    {"id": 0, "speakers": ["M", "F", ...], "text": [[...], ...], "audio": [[...], ...], "vision": [[...], ...],
+     "missing": [[0, 1, 0], ...]}
+a modality may be null, "missing" (per utterance over text, audio, vision, 1 = missing) is optional.
+The answer is {"id": 0, "pred": [...], "prob": [[...], ...]}, {"cmd": "stats"} returns the queue depth,
+the batch sizes and the latency percentiles of the last --statWindow requests.
+Queued dialogues are merged with dgl.batch into one forward of at most --maxBatch dialogues, the batch waits
+at most --maxWait ms to fill up, forwards run one at a time on a worker thread.
+"""
+import asyncio
+import json
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from config import buildParser
+from dataloader import MissingCollator, dialogueGraph, forwardEdges, similarityGraph
+from model import GAT_FP
+from ultis import DEVICE
+
+DIMS = {'text': 1024, 'audio': 512, 'vision': 1024}
+MAX_SIZE = 120
+# one JSON line holds a whole dialogue
+LINE_LIMIT = 2**26
+
+
+def requestGraph(request, args, numLB):
+    numNode = len(request['speakers'])
+    if not 0 < numNode < MAX_SIZE:
+        raise ValueError(f'a dialogue has 1 to {MAX_SIZE - 1} utterances, got {numNode}')
+    missingMask = np.zeros((3, numNode))
+    if request.get('missing') is not None:
+        missingMask = np.asarray(request['missing'], dtype=np.float64).reshape(numNode, 3).T.copy()
+    features = []
+    for ii, key in enumerate(('text', 'audio', 'vision')):
+        if request.get(key) is None:
+            features.append(np.zeros((numNode, DIMS[key]), dtype=np.float32))
+            missingMask[ii] = 1
+        else:
+            features.append(np.asarray(request[key], dtype=np.float32).reshape(numNode, DIMS[key]))
+    if args.edgeType == 0:
+        edges = similarityGraph(features, missingMask, args.simTopK, args.simThreshold, MAX_SIZE)
+    else:
+        edges = forwardEdges(numNode, MAX_SIZE)
+    g, labels = dialogueGraph(*features, np.zeros(numNode), request['speakers'], missingMask, edges, numLB, MAX_SIZE)
+    return g, labels, numNode
+
+
+class MicroBatcher():
+    """Queues dialogues and runs them as batched graphs, one forward per batch on a single worker thread."""
+    def __init__(self, model, maxBatch = 32, maxWait = 5.0, window = 10000, device = DEVICE):
+        self.model = model.eval()
+        self.maxBatch = maxBatch
+        self.maxWait = maxWait / 1000
+        self.device = device
+        self.collate = MissingCollator().collate
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = asyncio.Queue()
+        self.latency = deque(maxlen=window)
+        self.batchSize = deque(maxlen=window)
+        self.numRequest = 0
+        self.numBatch = 0
+
+    async def submit(self, g, labels, numNode):
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((g, labels, numNode, future, time.perf_counter()))
+        return await future
+
+    async def nextBatch(self, getter):
+        # a pending get is carried over to the next batch instead of being cancelled, so no request is dropped
+        loop = asyncio.get_event_loop()
+        batch = [await getter]
+        getter = None
+        deadline = loop.time() + self.maxWait
+        while len(batch) < self.maxBatch:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            getter = asyncio.ensure_future(self.queue.get())
+            done, _ = await asyncio.wait({getter}, timeout=timeout)
+            if not done:
+                break
+            batch.append(getter.result())
+            getter = None
+        return batch, getter
+
+    async def run(self):
+        # a failing batch is reported to its clients and logged, the loop keeps serving the next batches
+        loop = asyncio.get_event_loop()
+        getter = None
+        while True:
+            batch, getter = await self.nextBatch(getter or asyncio.ensure_future(self.queue.get()))
+            try:
+                prob = await loop.run_in_executor(self.executor, self.forward, [item[:2] for item in batch])
+                now = time.perf_counter()
+                self.numBatch += 1
+                self.numRequest += len(batch)
+                self.batchSize.append(len(batch))
+                for (_, _, numNode, future, start), dialogueProb in zip(batch, prob):
+                    self.latency.append(now - start)
+                    # the client may have disconnected and cancelled its future
+                    if not future.done():
+                        future.set_result(dialogueProb[:numNode])
+            except Exception as error:
+                traceback.print_exc()
+                for item in batch:
+                    if not item[3].done():
+                        item[3].set_exception(error)
+
+    def forward(self, items):
+        g, _ = self.collate(items)
+        with torch.no_grad():
+            prob = torch.softmax(self.model(g.to(self.device)).float(), 1)
+        return prob.view(len(items), MAX_SIZE, -1).cpu().numpy()
+
+    def stats(self):
+        latency = np.asarray(self.latency) * 1000
+        p50, p95, p99 = np.percentile(latency, [50, 95, 99]) if len(latency) else (0.0, 0.0, 0.0)
+        return {'queue': self.queue.qsize(), 'requests': self.numRequest, 'batches': self.numBatch,
+                'meanBatch': float(np.mean(self.batchSize)) if self.batchSize else 0.0,
+                'p50': float(p50), 'p95': float(p95), 'p99': float(p99), 'dims': DIMS, 'maxSize': MAX_SIZE}
+
+
+async def handle(reader, writer, batcher, args, numLB):
+    # requests of one connection are answered in order, clients open several connections for concurrency
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        request = {}
+        try:
+            request = json.loads(line)
+            if request.get('cmd') == 'stats':
+                response = batcher.stats()
+            else:
+                g, labels, numNode = requestGraph(request, args, numLB)
+                prob = await batcher.submit(g, labels, numNode)
+                response = {'id': request.get('id'), 'pred': prob.argmax(1).tolist(), 'prob': prob.round(5).tolist()}
+        except Exception as error:
+            response = {'id': request.get('id') if isinstance(request, dict) else None, 'error': str(error)}
+        writer.write((json.dumps(response) + '\n').encode())
+        await writer.drain()
+    writer.close()
+
+
+def workerDone(worker):
+    if not worker.cancelled() and worker.exception() is not None:
+        print('Batching worker stopped:', repr(worker.exception()))
+
+
+async def serve(args, model, numLB, device):
+    batcher = MicroBatcher(model, args.maxBatch, args.maxWait, args.statWindow, device)
+    worker = asyncio.ensure_future(batcher.run())
+    worker.add_done_callback(workerDone)
+    handler = lambda reader, writer: handle(reader, writer, batcher, args, numLB)
+    if args.socket:
+        server = await asyncio.start_unix_server(handler, path=args.socket, limit=LINE_LIMIT)
+        print(f'Serving on {args.socket}')
+    else:
+        server = await asyncio.start_server(handler, args.host, args.port, limit=LINE_LIMIT)
+        print(f'Serving on {args.host}:{args.port}')
+    try:
+        await server.serve_forever()
+    finally:
+        worker.cancel()
+        batcher.executor.shutdown()
+
+
+if __name__ == "__main__":
+    parser = buildParser()
+    parser.add_argument('--modelPath', help='state dict saved by main.py --saveModel', default='')
+    parser.add_argument('--quantizedPath', help='int8 state dict saved by quantize.py, served on CPU', default='')
+    parser.add_argument('--quantizeLSTM', action='store_true', default=False, help='the int8 model was saved with --quantizeLSTM')
+    parser.add_argument('--host', help='TCP host', default='127.0.0.1')
+    parser.add_argument('--port', help='TCP port', default=8765, type=int)
+    parser.add_argument('--socket', help='serve on this Unix socket instead of TCP', default='')
+    parser.add_argument('--maxBatch', help='dialogues per forward', default=32, type=int)
+    parser.add_argument('--maxWait', help='ms a batch waits for more dialogues', default=5.0, type=float)
+    parser.add_argument('--statWindow', help='requests kept for the latency percentiles', default=10000, type=int)
+    args = parser.parse_args()
+
+    numLB = 4 if args.numLabel == '4' else 6
+    device = DEVICE
+    if args.quantizedPath:
+        from quantize import CPU, loadQuantized
+        device = CPU
+        model = loadQuantized(args.quantizedPath, numLB, args, args.quantizeLSTM)
+    else:
+        model = GAT_FP(numLB, args.wFP, args, probality = True)
+        if args.modelPath:
+            model.load_state_dict(torch.load(args.modelPath, map_location=DEVICE))
+        else:
+            print('No --modelPath, serving an untrained model')
+        model = model.to(device)
+    asyncio.run(serve(args, model, numLB, device))
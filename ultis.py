@@ -1,15 +1,13 @@
+import copy
 import random 
+import sys
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 import torch 
 import numpy as np 
 from torch import nn
 import torch.nn.functional as F
-from sklearn.metrics import f1_score
 seed = 1001
-from sklearn.manifold import TSNE
-import matplotlib.pyplot as plt
-import seaborn as sns
-from matplotlib.colors import ListedColormap
-from tqdm import tqdm
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 seedList = [1001, 9138, 86503, 37949, 22627, 75258, 94877, 9829, 47702, 15908]
 import os
@@ -30,10 +28,30 @@ def seed_everything(seed=seed):
 cos = nn.CosineSimilarity(dim=0, eps=1e-6)
 
 
+def progress(iterable):
+    # progress bar only on an interactive terminal, tqdm is imported on first use
+    if not sys.stderr.isatty():
+        return iterable
+    from tqdm import tqdm
+    return tqdm(iterable)
+
+
 def featureSimilarity(v1, v2):
     similar = 1.0 - torch.acos(cos(v1, v2))/ np.pi
     return similar
 
+def angularSimilarity(features, present):
+    """
+    Batched featureSimilarity over all utterance pairs.
+    features: modality x node x dim (zero padded to a common dim), present: modality x node.
+    Returns node x node similarity averaged over the modalities both utterances have.
+    """
+    unit = F.normalize(features, dim=-1)
+    cosine = torch.bmm(unit, unit.transpose(1, 2)).clamp(-1.0, 1.0)
+    similar = 1.0 - torch.acos(cosine) / np.pi
+    shared = present.unsqueeze(2) * present.unsqueeze(1)
+    return (similar * shared).sum(0) / shared.sum(0).clamp(min=1)
+
 def convertNP2Tensor(listV):
     listR = []
     for xx in listV:
@@ -41,41 +59,51 @@ def convertNP2Tensor(listV):
     return listR
 
 class FocalLoss(nn.Module):
-    def __init__(self, gamma = 2.5, alpha = 1, size_average = True):
+    def __init__(self, gamma = 2.5, alpha = None, reduction = 'mean', ignore_index = None):
+        """
+        alpha: None, a scalar or a per class weight tensor
+        reduction: mean, sum or none
+        ignore_index: label dropped before the loss (padding nodes)
+        """
         super(FocalLoss, self).__init__()
         self.gamma = gamma
-        self.alpha = alpha
-        self.size_average = size_average
-        self.elipson = 0.000001
-    
+        self.reduction = reduction
+        self.ignore_index = ignore_index
+        if torch.is_tensor(alpha):
+            self.register_buffer('alpha', alpha.float())
+        else:
+            self.alpha = alpha
+
     def forward(self, logits, labels):
         """
-        cal culates loss
-        logits: batch_size * labels_length * seq_length
-        labels: batch_size * seq_length
+        logits: num_samples * num_labels
+        labels: num_samples
         """
-        if labels.dim() > 2:
-            labels = labels.contiguous().view(labels.size(0), labels.size(1), -1)
-            labels = labels.transpose(1, 2)
-            labels = labels.contiguous().view(-1, labels.size(2)).squeeze()
-        if logits.dim() > 3:
-            logits = logits.contiguous().view(logits.size(0), logits.size(1), logits.size(2), -1)
-            logits = logits.transpose(2, 3)
-            logits = logits.contiguous().view(-1, logits.size(1), logits.size(3)).squeeze()
-        labels_length = logits.size(1)
-        seq_length = logits.size(0)
-
-        new_label = labels.unsqueeze(1)
-        label_onehot = torch.zeros([seq_length, labels_length]).cuda().scatter_(1, new_label, 1)
-
-        log_p = F.log_softmax(logits)
-        pt = label_onehot * log_p
-        sub_pt = 1 - pt
-        fl = -self.alpha * (sub_pt)**self.gamma * log_p
-        if self.size_average:
-            return fl.mean()
-        else:
+        if self.ignore_index is not None:
+            keep = labels != self.ignore_index
+            logits = logits[keep]
+            labels = labels[keep]
+        log_p = F.log_softmax(logits.float(), dim=1).gather(1, labels.unsqueeze(1)).squeeze(1)
+        fl = -(1 - log_p.exp()) ** self.gamma * log_p
+        weight = None
+        if torch.is_tensor(self.alpha):
+            weight = self.alpha[labels]
+            fl = weight * fl
+        elif self.alpha is not None:
+            fl = self.alpha * fl
+        if self.reduction == 'sum':
             return fl.sum()
+        if self.reduction == 'mean':
+            # weighted mean, as nn.CrossEntropyLoss with class weights
+            return fl.sum() / weight.sum() if weight is not None else fl.mean()
+        return fl
+
+
+def classWeight(labels, numClass):
+    # inverse label frequency, normalised to mean 1
+    count = np.bincount(np.asarray(labels, dtype=np.int64), minlength=numClass).astype(np.float64)
+    weight = 1.0 / np.maximum(count, 1)
+    return torch.from_numpy(weight / weight.mean())
 
 def norm(features):
     meanMat = np.mean(features, axis=0, keepdims=True)
@@ -87,41 +115,27 @@ def norm(features):
     return newFeatures
 
 def vis(info):
-    print('Visualize')
-    X0, y0 = info
-    visData = [[X0, y0]]
-    embeddings = visData[0][0]
-    tsne = TSNE(n_components=2)
-    transformed = tsne.fit_transform(embeddings)
-
-    palette = sns.color_palette("bright", len(np.unique(y0)))
-    g = sns.scatterplot(
-        x=transformed[:,0],
-        y=transformed[:,1],
-        hue=visData[0][1],
-        legend='full',
-        palette=palette
-    )
-    # _lg = g.get_legend()
-    # _lg.remove()
-    plt.show()
-
-def evaluate(dataloader, model, numLB):
+    # kept for old call sites, the scalable projection lives in embedding.py
+    from embedding import vis as projectAndPlot
+    projectAndPlot(info)
+
+def evaluate(dataloader, model, numLB, device = DEVICE):
+    from sklearn.metrics import f1_score
     model.eval()
     counter = 0
     total = 0
     preds = []
     trueLabel = []
-    for batch_idx, batch in enumerate(tqdm(dataloader)):
+    for batch_idx, batch in enumerate(progress(dataloader)):
         g, labels = batch
         labels = g.ndata["label"]
         labels = labels.type(torch.LongTensor)   
         trueLabel.extend(labels.cpu().numpy())
-        g = g.to(DEVICE)
+        g = g.to(device)
         with torch.no_grad():
             pred = model(g)
             res = torch.argmax(pred, 1)
-            res = res.to(DEVICE)
+            res = res.to(device)
             preds.extend(res.cpu().numpy())
     trueLabel = np.asarray(trueLabel)
     preds = np.asarray(preds)
@@ -131,6 +145,72 @@ def evaluate(dataloader, model, numLB):
     return f1_score(trueLabel, preds, average='weighted')
 
 
+def evaluateEnsemble(dataloader, models, numLB, device = DEVICE):
+    """Weighted F1 of every member and of the ensemble (mean softmax), in a single pass over the data."""
+    from sklearn.metrics import f1_score
+    from model import ensembleForward
+    for model in models:
+        model.eval()
+    preds = [[] for _ in models]
+    ensemble = []
+    trueLabel = []
+    for batch_idx, batch in enumerate(progress(dataloader)):
+        g, labels = batch
+        labels = g.ndata["label"]
+        labels = labels.type(torch.LongTensor)
+        trueLabel.extend(labels.cpu().numpy())
+        g = g.to(device)
+        with torch.no_grad():
+            prob = torch.stack([F.softmax(logits.float(), 1) for logits in ensembleForward(models, g)])
+            for idx in range(len(models)):
+                preds[idx].extend(torch.argmax(prob[idx], 1).cpu().numpy())
+            ensemble.extend(torch.argmax(prob.mean(0), 1).cpu().numpy())
+    trueLabel = np.asarray(trueLabel)
+    pos = np.where(trueLabel != numLB)
+    acc = [f1_score(trueLabel[pos], np.asarray(pred)[pos], average='weighted') for pred in preds]
+    return acc, f1_score(trueLabel[pos], np.asarray(ensemble)[pos], average='weighted')
+
+
+class EvalScheduler():
+    """
+    Per-epoch evaluation, inline or (asynchronous) on a background thread against a copy of the weights taken
+    at the end of the epoch, so the next epoch trains meanwhile. collect() returns (epoch, loss, metric)
+    in epoch order, metric is None for epochs submitted without a model.
+    """
+    def __init__(self, evaluateFn, model, asynchronous = False):
+        self.evaluateFn = evaluateFn
+        self.asynchronous = asynchronous
+        self.pending = deque()
+        if asynchronous:
+            # one worker: snapshots are evaluated one after the other on a single eval model
+            self.evalModel = copy.deepcopy(model)
+            self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def submit(self, epoch, loss, model = None):
+        if model is None or not self.asynchronous:
+            future = Future()
+            future.set_result(None if model is None else self.evaluateFn(model))
+        else:
+            state = {key: value.detach().clone() for key, value in model.state_dict().items()}
+            future = self.executor.submit(self.evaluateSnapshot, state)
+        self.pending.append((epoch, loss, future))
+
+    def evaluateSnapshot(self, state):
+        self.evalModel.load_state_dict(state)
+        return self.evaluateFn(self.evalModel)
+
+    def collect(self, wait = False):
+        results = []
+        while self.pending and (wait or self.pending[0][2].done()):
+            epoch, loss, future = self.pending.popleft()
+            results.append((epoch, loss, future.result()))
+        return results
+
+    def close(self):
+        if self.asynchronous:
+            self.executor.shutdown()
+
+
 def normMat(X_train, refer, ax = 1):
     mean = np.mean(refer, axis=ax, keepdims=True)
     std = np.std(refer, axis=ax, keepdims=True)